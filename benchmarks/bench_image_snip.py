@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the image_snip pipeline.
+
+Generates synthetic JPEG images at several sizes, times each process
+instruction on its own, make_gif, and an end-to-end main() run, and
+reports images/sec, MB/sec (of RGB source pixels), and peak RSS.
+
+Each case runs in a fresh worker process so its peak RSS is not mixed up
+with the other cases.
+
+Examples:
+
+    python benchmarks/bench_image_snip.py --sizes 400x400,1920x1440
+    python benchmarks/bench_image_snip.py --save baseline.json
+    python benchmarks/bench_image_snip.py --compare baseline.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+import PIL
+from PIL import Image, ImageFont
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import image_snip  # noqa: E402
+
+DEFAULT_SIZES = "400x400,1920x1440,4000x3000,8000x6000"
+
+#  Process instructions timed on their own, by case name. Sizes are
+#  scaled from a 1920x1440 reference so each case does similar work on
+#  every image size.
+STEP_CASES = {
+    "crop_from_center": "crop_from_center({w2}, {h2})",
+    "crop_from_left_top": "crop_from_left_top({w2}, {h2})",
+    "crop_from_right_bottom": "crop_from_right_bottom({w2}, {h2})",
+    "crop_to_box": "crop_to_box({w4}, {h4}, {w2}, {h2})",
+    "crop_zoom": "crop_zoom({w4}, {w4})",
+    "border": "border({b})",
+    "border_inset": "border_inset({b})",
+    "border_expand": "border_expand({b})",
+    "rounded": "rounded({r}, {b})",
+    "text_footers": 'text_footers("default", 16, 2)',
+}
+
+MIN_RUN_SECONDS = 0.05  # Fast calls are looped for at least this long.
+GIF_FRAMES = 5
+GIF_MAX_PIXELS = 1920 * 1440  # Larger sizes are skipped for make_gif.
+MAIN_FILES = 4
+MAIN_PROCS = ["crop_from_center({w2}, {h2})", "crop_zoom({w4}, {w4})", "border(4)"]
+
+
+class BenchResult(NamedTuple):
+    case: str
+    size: str
+    images: int
+    seconds: float
+    images_per_sec: float
+    mb_per_sec: float
+    peak_rss_mb: float | None
+
+
+def parse_size(text: str) -> tuple[int, int]:
+    w, h = text.lower().split("x")
+    return (int(w), int(h))
+
+
+def size_args(size: tuple[int, int]) -> dict[str, int]:
+    w, h = size
+    return {
+        "w2": w // 2,
+        "h2": h // 2,
+        "w4": max(1, w // 4),
+        "h4": max(1, h // 4),
+        "b": max(2, w // 200),
+        "r": max(4, w // 40),
+    }
+
+
+def make_test_image(size: tuple[int, int], file_path: Path):
+    """Write a JPEG with gradients and noise, so it compresses like a photo."""
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 40)
+    rotated = gradient.transpose(Image.Transpose.ROTATE_90).resize(size)
+    Image.merge("RGB", (gradient, noise, rotated)).save(file_path, quality=90)
+
+
+def peak_rss_mb() -> float | None:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    rss = max(rss, children)
+    #  ru_maxrss is in bytes on macOS, kilobytes elsewhere.
+    if sys.platform == "darwin":
+        return rss / (1024 * 1024)
+    return rss / 1024
+
+
+def time_repeated(func, repeat: int) -> float:
+    """
+    Return the best (lowest) time, in seconds, of one call to func over
+    repeat runs. Like timeit, calls that take less than MIN_RUN_SECONDS
+    are looped within each run and the average is used.
+    """
+    start = time.perf_counter()
+    func()
+    first = time.perf_counter() - start
+    loops = 1 if first >= MIN_RUN_SECONDS else int(MIN_RUN_SECONDS / max(first, 1e-6))
+
+    best = first if loops == 1 else None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = (time.perf_counter() - start) / loops
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_step(case: str, image_file: str, repeat: int):
+    """Time one compiled step applied to an image already in memory."""
+    with Image.open(image_file) as src:
+        img = src.convert("RGB")
+
+    proc = STEP_CASES[case].format(**size_args(img.size))
+    steps, errors = image_snip.compile_steps([proc])
+    if errors:
+        raise SystemExit(f"{case}: {errors}")
+    step = steps[0]
+
+    font = ImageFont.load_default(16)
+    ctx = image_snip.ProcContext(
+        image_snip.FileInfo(Path(image_file), "Caption"), 1, 1, font
+    )
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds = time_repeated(lambda: step.apply(img, ctx), repeat)
+
+    return seconds, 1, peak_rss_mb()
+
+
+def bench_make_gif(image_file: str, repeat: int, out_dir: str):
+    with Image.open(image_file) as src:
+        img = src.convert("RGB")
+
+    frames = [img.rotate(n * 5) for n in range(GIF_FRAMES)]
+    gif_path = Path(out_dir) / "bench.gif"
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds = time_repeated(
+            lambda: image_snip.make_gif(100, iter(frames), gif_path), repeat
+        )
+
+    return seconds, GIF_FRAMES, peak_rss_mb()
+
+
+def bench_main(image_file: str, repeat: int, out_dir: str, workers: int):
+    """Time main() end-to-end on MAIN_FILES copies of the image."""
+    with Image.open(image_file) as src:
+        size = src.size
+
+    procs = "\n".join(p.format(**size_args(size)) for p in MAIN_PROCS)
+    files = "\n".join([image_file] * MAIN_FILES)
+    opt_file = Path(out_dir) / "bench-options.txt"
+    opt_file.write_text(
+        f"output_folder: {out_dir}\nnew_name: bench\nworkers: {workers}\n"
+        f"{procs}\n{files}\n"
+    )
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            image_snip.main(["-o", str(opt_file)])
+
+    seconds = time_repeated(run, repeat)
+
+    return seconds, MAIN_FILES, peak_rss_mb()
+
+
+def run_case(case: str, image_file: str, repeat: int, workers: int):
+    """Runs in a fresh process. Returns (seconds, images, peak_rss_mb)."""
+    with tempfile.TemporaryDirectory() as out_dir:
+        if case == "make_gif":
+            return bench_make_gif(image_file, repeat, out_dir)
+        if case == "main":
+            return bench_main(image_file, repeat, out_dir, workers)
+        return bench_step(case, image_file, repeat)
+
+
+def run_benchmarks(args) -> list[BenchResult]:
+    sizes = [parse_size(s) for s in args.sizes.split(",")]
+    cases = [*STEP_CASES, "make_gif", "main"]
+    if args.only:
+        only = args.only.split(",")
+        cases = [c for c in cases if any(c.startswith(o) for o in only)]
+
+    results = []
+    mp_context = multiprocessing.get_context("spawn")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            size_tag = f"{size[0]}x{size[1]}"
+            image_file = str(Path(tmp) / f"bench-{size_tag}.jpg")
+            make_test_image(size, Path(image_file))
+            mb = size[0] * size[1] * 3 / 1_000_000
+
+            for case in cases:
+                if case == "make_gif" and size[0] * size[1] > GIF_MAX_PIXELS:
+                    continue
+
+                with ProcessPoolExecutor(1, mp_context=mp_context) as executor:
+                    seconds, images, rss = executor.submit(
+                        run_case, case, image_file, args.repeat, args.workers
+                    ).result()
+
+                result = BenchResult(
+                    case,
+                    size_tag,
+                    images,
+                    seconds,
+                    images / seconds,
+                    mb * images / seconds,
+                    rss,
+                )
+                print_result(result)
+                results.append(result)
+
+    return results
+
+
+def print_header():
+    print(
+        f"{'case':<24} {'size':>10} {'seconds':>9} {'img/s':>9} "
+        f"{'MB/s':>9} {'RSS MB':>8}"
+    )
+
+
+def print_result(r: BenchResult):
+    rss = "-" if r.peak_rss_mb is None else f"{r.peak_rss_mb:.0f}"
+    print(
+        f"{r.case:<24} {r.size:>10} {r.seconds:>9.4f} {r.images_per_sec:>9.2f} "
+        f"{r.mb_per_sec:>9.1f} {rss:>8}"
+    )
+
+
+def results_to_json(results: list[BenchResult]) -> dict:
+    return {
+        "image_snip": image_snip.__version__,
+        "pillow": PIL.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": [r._asdict() for r in results],
+    }
+
+
+def compare(results: list[BenchResult], baseline_file: str, threshold: float) -> int:
+    """
+    Print the change in time for each case compared to the baseline file.
+    Returns the number of cases that are slower by more than threshold.
+    """
+    baseline = json.loads(Path(baseline_file).read_text())
+    base = {(r["case"], r["size"]): r for r in baseline["results"]}
+
+    print(f"\nCompared to '{baseline_file}' (image_snip {baseline['image_snip']}):")
+    regressions = 0
+    for r in results:
+        b = base.get((r.case, r.size))
+        if b is None:
+            continue
+        change = (r.seconds - b["seconds"]) / b["seconds"]
+        flag = ""
+        if change > threshold:
+            flag = "  <-- SLOWER"
+            regressions += 1
+        print(f"{r.case:<24} {r.size:>10} {change:>+8.1%}{flag}")
+
+    return regressions
+
+
+def get_args(arglist=None):
+    ap = argparse.ArgumentParser(description="Benchmarks for image_snip.")
+    ap.add_argument(
+        "--sizes",
+        default=DEFAULT_SIZES,
+        help=f"Comma-separated image sizes (default: {DEFAULT_SIZES}).",
+    )
+    ap.add_argument(
+        "--only",
+        default="",
+        help="Comma-separated case name prefixes to run (default: all).",
+    )
+    ap.add_argument(
+        "--repeat", type=int, default=3, help="Runs per case; best is kept."
+    )
+    ap.add_argument(
+        "--workers", type=int, default=1, help="'workers:' setting for main()."
+    )
+    ap.add_argument("--save", help="Write the results to this JSON file.")
+    ap.add_argument("--compare", help="Compare with results from this JSON file.")
+    ap.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="Fraction slower than the baseline reported as a regression.",
+    )
+    return ap.parse_args(arglist)
+
+
+def main(arglist=None):
+    args = get_args(arglist)
+
+    print(f"{image_snip.app_label}, Pillow {PIL.__version__}\n")
+    print_header()
+    results = run_benchmarks(args)
+
+    if args.save:
+        Path(args.save).write_text(json.dumps(results_to_json(results), indent=2))
+        print(f"\nSaved '{args.save}'")
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,15 +3,34 @@
 from __future__ import annotations
 
 import argparse
+import csv
+import hashlib
 import io
+import json
+import os
+import re
+import shutil
+import struct
 import sys
-from dataclasses import dataclass
+import tarfile
+import threading
+import time
+import tracemalloc
+import warnings
+from abc import ABC, abstractmethod
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from dataclasses import dataclass, fields
 from datetime import datetime
+from functools import lru_cache
+from itertools import chain, islice
 from pathlib import Path
-from textwrap import dedent
+from textwrap import dedent, indent
 from typing import NamedTuple
 
-from PIL import Image, ImageDraw, ImageFilter, ImageFont
+from PIL import Image, ImageDraw, ImageFilter, ImageFont, ImageOps, features
 
 #  Using calver (YYYY.0M.MICRO).
 __version__ = "2026.06.1"
@@ -26,6 +45,137 @@ FOOTER_BACKGROUND_RGB = (25, 25, 112)
 TIMESTAMP_SEC = 1  # Add date_time to file name, to the second.
 TIMESTAMP_MIC = 2  # Add date_time to file name, to the microsecond.
 
+PROFILE_OFF = 0
+PROFILE_TIME = 1  # Record wall and CPU time for each stage.
+PROFILE_MEMORY = 2  # Also record the tracemalloc peak for each stage.
+
+#  Quantize methods for a palette shared by all frames of an animated GIF.
+GIF_PALETTE_METHODS = {
+    "median": Image.Quantize.MEDIANCUT,
+    "octree": Image.Quantize.FASTOCTREE,
+    "libimagequant": Image.Quantize.LIBIMAGEQUANT,
+}
+GIF_PALETTE_SAMPLE_FRAMES = 16  # Max. frames sampled to build the palette.
+GIF_PALETTE_SAMPLE_PX = 160  # Max. width/height of each sampled frame.
+
+#  How animated GIF frames that differ in size from the first frame are
+#  made to fit: stretch, center-crop, or fit inside with bars.
+GIF_FIT_MODES = ("resize", "crop", "letterbox")
+
+#  Ways images are framed on stdin/stdout in --stream mode: one image,
+#  a sequence of (8-byte big-endian length, data) records, or a tar file.
+STREAM_MODES = ("single", "length", "tar")
+STREAM_LENGTH = struct.Struct(">Q")
+
+#  How a source file is identified in incremental mode: by its modified
+#  time and size, or by a hash of its content.
+INCREMENTAL_MODES = ("mtime", "hash")
+MANIFEST_NAME = "image_snip_manifest.json"
+
+CACHE_MAX_MB = 1024  # Default size limit of the result cache.
+
+#  A job's memory is estimated as the decoded source (width x height x
+#  bands, at least RGB) times this factor, for the working copies made by
+#  the steps and the encoder.
+JOB_MEMORY_FACTOR = 3
+MEMORY_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+
+#  Threads that save results when source files are prefetched.
+WRITE_THREADS = 2
+
+#  Threads that check the image file paths in the options file, one
+#  folder at a time.
+CHECK_FILES_THREADS = 16
+
+#  An image file line with any of these characters is a glob pattern.
+GLOB_CHARS = "*?["
+
+#  Name of the output folder made when there is no output_folder setting.
+#  Files in such folders are left out when patterns are expanded.
+DEFAULT_OUTPUT_FOLDER = re.compile(r"crop_\d{8}_\d{6}")
+
+#  Sort keys for the files from a glob pattern or folder line. 'none'
+#  keeps the order the files are found, without listing them first.
+FILE_SORT_KEYS = {
+    "name": str,
+    "mtime": lambda p: p.stat().st_mtime_ns,
+    "size": lambda p: p.stat().st_size,
+    "none": None,
+}
+
+#  A line that looks like a process instruction, 'name(...)' or 'name(...'
+#  with nothing after the closing parenthesis, or a setting, 'name: ...'
+#  (but not a Windows drive, 'C:\'), rather than a file name. Lines ending
+#  in an image file extension are file names (see is_instruction_like).
+INSTRUCTION_LIKE = re.compile(r"^\w+\s*(\([^)]*\)?|:(?![\\/]).*)$")
+
+#  Output formats, and the Pillow feature each needs (None = built in).
+OUTPUT_FORMATS = {"JPG": None, "PNG": None, "WEBP": "webp", "AVIF": "avif"}
+
+JPEG_SUBSAMPLING = ("4:4:4", "4:2:2", "4:2:0")
+
+#  Encoder settings used by encoder_preset. Settings given in the options
+#  file override the preset. 'fast' is for quick, throwaway previews.
+ENCODER_PRESETS = {
+    "default": {},
+    "fast": {
+        "jpeg_quality": 60,
+        "jpeg_progressive": False,
+        "jpeg_optimize": False,
+        "jpeg_subsampling": "4:2:0",
+        "png_compress_level": 1,
+        "png_optimize": False,
+        "webp_method": 0,
+        "avif_speed": 10,
+    },
+}
+
+RESAMPLE_FILTERS = {
+    "nearest": Image.Resampling.NEAREST,
+    "bilinear": Image.Resampling.BILINEAR,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
+
+class ImageSnipError(Exception):
+    """
+    Raised when an image cannot be processed. The message is reported
+    by main() after all files have been handled.
+    """
+
+
+class EncodeOptions(NamedTuple):
+    """
+    Encoder settings passed to Image.save(). None means Pillow's default.
+    """
+
+    jpeg_quality: int | None = None
+    jpeg_progressive: bool = False
+    jpeg_optimize: bool = False
+    jpeg_subsampling: str | None = None
+    png_compress_level: int | None = None
+    png_optimize: bool = False
+    webp_quality: int | None = None
+    webp_method: int | None = None
+    webp_lossless: bool = False
+    avif_quality: int | None = None
+    avif_speed: int | None = None
+
+
+class Branch(NamedTuple):
+    """
+    A named output, declared with 'branch: name' in the options file. Its
+    steps are applied after the shared steps, and it is saved with its
+    own output format and suffix.
+    """
+
+    name: str
+    proc_list: list[str]
+    steps: tuple[Step, ...]
+    output_format: str
+    output_suffix: str
+
 
 @dataclass
 class FileInfo:
@@ -33,10 +183,23 @@ class FileInfo:
     text: str = None
 
 
+@dataclass
+class FilePattern:
+    """
+    A glob pattern, or a folder, from the image file list. It is expanded
+    to a FileInfo for each image file, with the same caption text, as the
+    files are processed (see iter_files).
+    """
+
+    pattern: str = None
+    text: str = None
+    is_folder: bool = False
+
+
 class AppOptions(NamedTuple):
     opts_text: str
     proc_list: list[str]
-    files: list[FileInfo]
+    files: list[FileInfo | FilePattern]
     output_dir: str
     new_name: str
     output_format: str
@@ -47,6 +210,129 @@ class AppOptions(NamedTuple):
     text_size: int
     text_numbering: int
     output_suffix: str
+    workers: int
+    steps: tuple[Step, ...]
+    gif_palette: str
+    gif_fit: str
+    gif_resample: str
+    gif_reducing_gap: float | None
+    profile: int
+    stream: str = ""
+    incremental: str = ""
+    cache_dir: str = ""
+    cache_max_mb: int = CACHE_MAX_MB
+    encode: EncodeOptions = EncodeOptions()
+    animation_format: str = "gif"
+    branches: tuple[Branch, ...] = ()
+    max_memory: int = 0
+    prefetch: int = 0
+    write_threads: int = WRITE_THREADS
+    file_sort: str = "name"
+    plan: bool = False
+    #  Number of image files, or 0 if it is not known until the glob
+    #  patterns and folders in files are expanded (see count_files).
+    file_count: int = 0
+
+
+class ProfileRecord(NamedTuple):
+    """
+    Time (in seconds) and memory used by one stage of processing a file.
+    file_num is 0 for stages that are not for a single file.
+    mem_peak is the tracemalloc peak in bytes (allocations made by Python,
+    not Pillow's own pixel buffers), or None if not recorded.
+    """
+
+    file_num: int
+    stage: str
+    wall: float
+    cpu: float
+    mem_peak: int | None = None
+
+
+class FileResult(NamedTuple):
+    file_num: int
+    file_name: str
+    error: str
+    image: Image.Image | None = None
+    profile: tuple[ProfileRecord, ...] = ()
+
+
+class FileOutputs(NamedTuple):
+    """
+    The processed images for a job, ready to be saved: (output_file_name,
+    image, cache_path) for each output. cache_path is None when there is
+    no result cache.
+    """
+
+    file_num: int
+    file_info: FileInfo
+    outputs: list[tuple[str, Image.Image, Path | None]]
+    timer: StageTimer
+
+
+#  Expected errors that fail a single job. Any other exception also fails
+#  only its job, but is reported with its type (see get_job_error).
+JOB_ERRORS = (ImageSnipError, OSError, Image.DecompressionBombError)
+
+
+#  Functions called, in the main process, with each ProfileRecord.
+#  See add_metrics_hook().
+metrics_hooks: list[Callable[[ProfileRecord], None]] = []
+
+
+def add_metrics_hook(hook: Callable[[ProfileRecord], None]):
+    """
+    Register a function to be called with each ProfileRecord, so an
+    application that embeds image_snip can collect its own metrics.
+    Stages are timed whenever a hook is registered, even without the
+    --profile option.
+    """
+    metrics_hooks.append(hook)
+
+
+def remove_metrics_hook(hook: Callable[[ProfileRecord], None]):
+    metrics_hooks.remove(hook)
+
+
+class StageTimer:
+    """
+    Records a ProfileRecord for each stage of processing one file, if
+    mode is PROFILE_TIME or PROFILE_MEMORY. Does nothing for PROFILE_OFF.
+    """
+
+    def __init__(self, file_num: int, mode: int):
+        self.file_num = file_num
+        self.mode = mode
+        self.records: list[ProfileRecord] = []
+        if mode == PROFILE_MEMORY and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.mode == PROFILE_OFF:
+            yield
+            return
+
+        #  The tracemalloc peak is for the whole process, so it is only
+        #  recorded for stages in the main thread. A stage timed in another
+        #  thread (saving, with prefetch) must not reset it.
+        trace_memory = (
+            self.mode == PROFILE_MEMORY
+            and threading.current_thread() is threading.main_thread()
+        )
+        if trace_memory:
+            tracemalloc.reset_peak()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            mem_peak = None
+            if trace_memory:
+                mem_peak = tracemalloc.get_traced_memory()[1]
+            self.records.append(ProfileRecord(self.file_num, name, wall, cpu, mem_peak))
 
 
 def get_new_size_zoom(current_size, target_size):
@@ -84,6 +370,26 @@ def crop_box_center(current_size, target_size):
     return (x1, y1, x2, y2)
 
 
+def get_zoom_box(current_size, target_size):
+    """
+    Returns (box, new_size) to scale an image of current_size so it covers
+    target_size and crop it from the center. box is the region that is
+    kept, in the coordinates of the image before scaling, and new_size is
+    the size it scales to.
+    """
+    zoom_size = get_new_size_zoom(current_size, target_size)
+    #  The zoomed size is rounded down, so may be a pixel short.
+    target_size = (
+        min(target_size[0], zoom_size[0]),
+        min(target_size[1], zoom_size[1]),
+    )
+    x1, y1, x2, y2 = crop_box_center(zoom_size, target_size)
+    scale_x = current_size[0] / zoom_size[0]
+    scale_y = current_size[1] / zoom_size[1]
+    box = (x1 * scale_x, y1 * scale_y, x2 * scale_x, y2 * scale_y)
+    return (box, (x2 - x1, y2 - y1))
+
+
 def crop_box_left_top(current_size, target_size):
     """
     Returns box coordinates (x1, y1, x2, y2) to
@@ -171,7 +477,10 @@ def get_output_name(
 
     #  '*' in new_name means keep the original file name.
     if opts.new_name and "*" not in opts.new_name:
-        if len(opts.files) > 1:
+        #  Numbered unless there is only one file. In --stream mode there
+        #  is no list of files, and with glob patterns or folders in the
+        #  list, the count is not known.
+        if opts.file_count != 1:
             file_stem = f"{opts.new_name}-{file_num:03d}"
         else:
             file_stem = opts.new_name
@@ -190,7 +499,7 @@ def get_output_name(
         file_stem = f"{p.stem}{opts.output_suffix}"
 
     if opts.output_format:
-        assert opts.output_format in ["JPG", "PNG"]
+        assert opts.output_format in OUTPUT_FORMATS
         ext = f".{opts.output_format.lower()}"
     else:
         ext = p.suffix
@@ -198,22 +507,64 @@ def get_output_name(
     return str(output_path.joinpath(f"{file_stem}{ext}"))
 
 
+def get_proc_args(proc: str, arg_counts: tuple[int, ...]) -> list[str]:
+    """
+    Returns the list of arguments, as stripped strings, from a process
+    instruction of the form 'name(arg, arg, ...)'. Raises ImageSnipError
+    if the instruction is malformed or the number of arguments is not one
+    of arg_counts.
+    """
+    a = proc.strip().split("(")
+    if len(a) != 2 or not a[1].endswith(")"):
+        raise ImageSnipError(f"Invalid process instruction: '{proc}'")
+
+    b = [x.strip() for x in a[1][:-1].split(",")]
+
+    if len(b) not in arg_counts:
+        expect = " or ".join(str(n) for n in arg_counts)
+        raise ImageSnipError(
+            f"Expected {expect} arguments, found {len(b)}, in '{proc}'"
+        )
+
+    return b
+
+
+def get_proc_ints(proc: str, arg_counts: tuple[int, ...]) -> list[int]:
+    """
+    Returns the list of integer arguments from a process instruction.
+    Raises ImageSnipError if any argument is not an integer.
+    """
+    try:
+        return [int(x) for x in get_proc_args(proc, arg_counts)]
+    except ValueError:
+        raise ImageSnipError(f"Expected integer arguments in '{proc}'") from None
+
+
+def check_rgb(proc: str, rgb: tuple[int, int, int]) -> tuple[int, int, int]:
+    if not all(0 <= x <= 255 for x in rgb):
+        raise ImageSnipError(f"RGB values must be from 0 to 255 in '{proc}'")
+    return rgb
+
+
 def extract_target_size(proc: str):
     """
     Extracts target size as a tuple of 2 integers (width, height) from
     a string that ends with two integers, in parentheses, separated by
     a comma.
     """
-    #  TODO: Replace assert with validation check and error message.
-    a = proc.strip(")").split("(")
-    assert len(a) == 2
-    b = a[1].split(",")
-    assert len(b) == 2
-    return (int(b[0]), int(b[1]))
+    width, height = get_proc_ints(proc, (2,))
+    if width < 1 or height < 1:
+        raise ImageSnipError(f"Width and height must be greater than 0 in '{proc}'")
+    return (width, height)
 
 
-def get_target_size(proc, current_size):
-    width, height = extract_target_size(proc)
+def get_target_size(proc, target_size, current_size):
+    """
+    Returns target_size (width, height) reduced, if needed, to fit within
+    current_size. A warning naming the process instruction (proc) is
+    printed if the size was reduced.
+    """
+    width, height = target_size
     msg = ""
 
     if current_size[0] < width:
@@ -241,10 +592,10 @@ def extract_gif_param(proc: str):
     display duration in milliseconds, from a string that ends with an
     integer, in parentheses.
     """
-    #  TODO: Replace assert with validation check and error message.
-    a = proc.strip(")").split("(")
-    assert len(a) == 2
-    return int(a[1])
+    (gif_ms,) = get_proc_ints(proc, (1,))
+    if gif_ms < 1:
+        raise ImageSnipError(f"Duration must be greater than 0 in '{proc}'")
+    return gif_ms
 
 
 def extract_text_param(s: str):
@@ -254,12 +605,16 @@ def extract_text_param(s: str):
     (integer), and a numbering option (integer) in parentheses,
     separated by a comma.
     """
-    #  TODO: Replace assert with validation check and error message.
-    a = s.strip(")").split("(")
-    assert len(a) == 2
-    b = a[1].split(",")
-    assert len(b) == 3
-    return (b[0].strip("'\""), int(b[1]), int(b[2]))
+    b = get_proc_args(s, (3,))
+    try:
+        font_size, numbering = int(b[1]), int(b[2])
+    except ValueError:
+        raise ImageSnipError(
+            f"Expected integer font size and numbering in '{s}'"
+        ) from None
+    if numbering not in (0, 1, 2):
+        raise ImageSnipError(f"Numbering must be 0, 1, or 2 in '{s}'")
+    return (b[0].strip("'\""), font_size, numbering)
 
 
 def extract_border_attrs(s: str):
@@ -267,17 +622,15 @@ def extract_border_attrs(s: str):
     Extract the attributes for adding a border to an image.
     Return (width, (R, G, B))
     """
-    #  TODO: Replace assert with validation check and error message.
-    a = s.strip(")").split("(")
-    assert len(a) == 2
+    b = get_proc_ints(s, (1, 4))
+    if b[0] < 0:
+        raise ImageSnipError(f"Border width cannot be negative in '{s}'")
 
-    if "," in a[1]:
-        b = [int(x) for x in a[1].split(",")]
-        assert len(b) == 4
-        return b[0], (b[1], b[2], b[3])
+    if len(b) == 4:
+        return b[0], check_rgb(s, (b[1], b[2], b[3]))
 
     #  Default border color same as text footer background color.
-    return (int(a[1]), FOOTER_BACKGROUND_RGB)
+    return (b[0], FOOTER_BACKGROUND_RGB)
 
 
 def extract_rounded_attrs(s: str):
@@ -286,22 +639,14 @@ def extract_rounded_attrs(s: str):
     Return (raduis, padding, (R, G, B)) or (raduis, padding, None)
     for transparent background.
     """
-    a = s.strip(")").split("(")
-    if len(a) != 2:
-        return (None, None, None)
-
-    if "," not in a[1]:
-        return (None, None, None)
-
-    b = [int(x) for x in a[1].split(",")]
+    b = get_proc_ints(s, (2, 5))
+    if b[0] < 0 or b[1] < 0:
+        raise ImageSnipError(f"Radius and padding cannot be negative in '{s}'")
 
     if len(b) == 5:
-        return b[0], b[1], (b[2], b[3], b[4])
-
-    if len(b) == 2:
-        return b[0], b[1], None
+        return b[0], b[1], check_rgb(s, (b[2], b[3], b[4]))
 
-    return (None, None, None)
+    return b[0], b[1], None
 
 
 def extract_target_box(proc: str):
@@ -310,27 +655,19 @@ def extract_target_box(proc: str):
     a string that ends with four integers, in parentheses, separated
     by a comma.
     """
-    #  TODO: Replace assert with validation check and error message.
-    a = proc.strip(")").split("(")
-    assert len(a) == 2
-    b = a[1].split(",")
-    assert len(b) == 4
-    return (int(b[0]), int(b[1]), int(b[2]), int(b[3]))
+    x1, y1, x2, y2 = get_proc_ints(proc, (4,))
+    if (x2 < x1) or (y2 < y1) or min(x1, y1) < 0:
+        raise ImageSnipError(f"Invalid box coordinates.\n  {proc}")
+    return (x1, y1, x2, y2)
 
 
-def get_target_box(proc, current_size):
+def get_target_box(box, current_size):
     """
     Return box coordinates (x1, y1, x2, y2) to crop image to target box.
     If the box coordinates are outside the current image size, the
-    coordinates are adjusted to fit the image size. If the box coordinates
-    are invalid, the program exits.
+    coordinates are adjusted to fit the image size.
     """
-    x1, y1, x2, y2 = extract_target_box(proc)
-
-    if (x2 < x1) or (y2 < y1):
-        sys.stderr.write("ERROR: Invalid box coordinates.\n")
-        sys.stderr.write(f"  {proc}\n")
-        sys.exit(1)
+    x1, y1, x2, y2 = box
 
     adjusted = False
     if current_size[0] < x1:
@@ -355,19 +692,359 @@ def get_target_box(proc, current_size):
     return (x1, y1, x2, y2)
 
 
+class ProcContext(NamedTuple):
+    """Per-file values passed to Step.apply()."""
+
+    file_info: FileInfo
+    file_num: int
+    file_count: int
+    font: ImageFont.ImageFont | ImageFont.FreeTypeFont | None
+
+
+@dataclass(frozen=True)
+class Step(ABC):
+    """
+    A compiled process instruction. Steps are validated once, by
+    compile_steps(), and then applied to each image. The original
+    instruction text is kept in proc for messages.
+    """
+
+    proc: str
+
+    @abstractmethod
+    def apply(self, img: Image.Image, ctx: ProcContext) -> Image.Image:
+        """Returns the image with the instruction applied."""
+
+    def get_size(self, size: tuple[int, int], ctx: ProcContext) -> tuple[int, int]:
+        """
+        Returns the size of the image that apply() would return for an
+        image of the given size, without touching any pixels. The same
+        warnings are printed as by apply().
+        """
+        return size
+
+
+CROP_BOX_FUNCS = {
+    "crop_from_center": crop_box_center,
+    "crop_from_left_top": crop_box_left_top,
+    "crop_from_right_top": crop_box_right_top,
+    "crop_from_left_bottom": crop_box_left_bottom,
+    "crop_from_right_bottom": crop_box_right_bottom,
+}
+
+
+@dataclass(frozen=True)
+class CropStep(Step):
+    """crop_from_center, crop_from_left_top, etc. (width, height)"""
+
+    anchor: str
+    size: tuple[int, int]
+
+    def get_crop_box(self, current_size):
+        target_size = get_target_size(self.proc, self.size, current_size)
+        return CROP_BOX_FUNCS[self.anchor](current_size, target_size)
+
+    def apply(self, img, ctx):
+        return img.crop(self.get_crop_box(img.size))
+
+    def get_size(self, size, ctx):
+        x1, y1, x2, y2 = self.get_crop_box(size)
+        return (x2 - x1, y2 - y1)
+
+
+@dataclass(frozen=True)
+class CropBoxStep(Step):
+    """crop_to_box(x1, y1, x2, y2)"""
+
+    box: tuple[int, int, int, int]
+
+    def get_crop_box(self, current_size):
+        return get_target_box(self.box, current_size)
+
+    def apply(self, img, ctx):
+        return img.crop(self.get_crop_box(img.size))
+
+    def get_size(self, size, ctx):
+        x1, y1, x2, y2 = self.get_crop_box(size)
+        return (x2 - x1, y2 - y1)
+
+
+@dataclass(frozen=True)
+class CropZoomStep(Step):
+    """
+    crop_zoom(width, height), with the resample filter (a RESAMPLE_FILTERS
+    key) and reducing_gap from the options file settings.
+    """
+
+    size: tuple[int, int]
+    resample: str = "bicubic"
+    reducing_gap: float | None = None
+
+    def get_zoom_box(self, size):
+        """
+        Returns (box, new_size) for an image of the given size (see
+        get_zoom_box).
+        """
+        return get_zoom_box(size, get_target_size(self.proc, self.size, size))
+
+    def apply(self, img, ctx):
+        #  Resample only the region that is kept, in one pass, rather than
+        #  resizing the whole image and then cropping it.
+        box, new_size = self.get_zoom_box(img.size)
+        return img.resize(
+            new_size,
+            RESAMPLE_FILTERS[self.resample],
+            box=box,
+            reducing_gap=self.reducing_gap,
+        )
+
+    def get_size(self, size, ctx):
+        return self.get_zoom_box(size)[1]
+
+
+#  Border instruction names and how the border is added: 'scale' shrinks
+#  the image to fit inside the border, 'inset' draws the border over the
+#  edges, 'expand' adds the border around the image.
+BORDER_MODES = {
+    "border": "scale",
+    "border_inset": "inset",
+    "border_expand": "expand",
+}
+
+
+@dataclass(frozen=True)
+class BorderStep(Step):
+    """
+    border(width) or border(width, red, green, blue), and the same for
+    border_inset and border_expand.
+    """
+
+    width: int
+    rgb: tuple[int, int, int]
+    mode: str = "scale"
+
+    def apply(self, img, ctx):
+        if self.mode == "inset":
+            return add_border_inset(img, self.width, self.rgb)
+        if self.mode == "expand":
+            return add_border_expand(img, self.width, self.rgb)
+        return add_border(img, self.width, self.rgb)
+
+    def get_size(self, size, ctx):
+        if self.mode == "expand":
+            return (size[0] + 2 * self.width, size[1] + 2 * self.width)
+        return size
+
+
+@dataclass(frozen=True)
+class RoundedStep(Step):
+    """rounded(radius, padding) or rounded(radius, padding, red, green, blue)"""
+
+    radius: int
+    padding: int
+    rgb: tuple[int, int, int] | None
+
+    def apply(self, img, ctx):
+        return add_rounded_border(img, self.radius, self.padding, self.rgb)
+
+
+@dataclass(frozen=True)
+class TextFooterStep(Step):
+    """text_footers("font-file-name", font-size, numbering)"""
+
+    font_name: str
+    font_size: int
+    numbering: int
+
+    def apply(self, img, ctx):
+        if ctx.font is None:
+            return img
+        return add_text_footer(
+            img,
+            ctx.file_info.text,
+            ctx.font,
+            self.font_size,
+            self.numbering,
+            ctx.file_num,
+            ctx.file_count,
+        )
+
+    def get_size(self, size, ctx):
+        if ctx.font is None:
+            return size
+        band_h = get_est_text_ht(ctx.font, self.font_size) + FOOTER_PAD_PX * 2
+        return (size[0], size[1] + band_h)
+
+
+def compile_step(
+    proc: str, resample: str = "bicubic", reducing_gap: float | None = None
+) -> Step:
+    """
+    Returns the Step for a process instruction. Raises ImageSnipError if
+    the instruction is unknown or its arguments are not valid. resample
+    and reducing_gap are used by crop_zoom.
+    """
+    name = proc.split("(", maxsplit=1)[0].strip()
+
+    if name in CROP_BOX_FUNCS:
+        return CropStep(proc, name, extract_target_size(proc))
+
+    if name == "crop_zoom":
+        return CropZoomStep(proc, extract_target_size(proc), resample, reducing_gap)
+
+    if name == "crop_to_box":
+        return CropBoxStep(proc, extract_target_box(proc))
+
+    if name in BORDER_MODES:
+        return BorderStep(proc, *extract_border_attrs(proc), BORDER_MODES[name])
+
+    if name == "rounded":
+        return RoundedStep(proc, *extract_rounded_attrs(proc))
+
+    if name == "text_footers":
+        return TextFooterStep(proc, *extract_text_param(proc))
+
+    raise ImageSnipError(f"Unknown process instruction in options file:\n'{proc}'")
+
+
+def compile_steps(
+    proc_list: list[str], resample: str = "bicubic", reducing_gap: float | None = None
+) -> tuple[tuple[Step, ...], list[str]]:
+    """
+    Returns (steps, errors) where steps is a tuple of Step objects for the
+    valid process instructions in proc_list, and errors is a list of
+    messages for the instructions that are not valid.
+    """
+    steps = []
+    errors = []
+    for proc in proc_list:
+        try:
+            steps.append(compile_step(proc, resample, reducing_gap))
+        except ImageSnipError as e:  # noqa: PERF203
+            errors.append(f"{e}")
+    return tuple(steps), errors
+
+
+class LoadPlan(NamedTuple):
+    """
+    How to load a source image for a list of steps.
+
+    box: Crop box, in source image coordinates, that replaces the leading
+      crop steps, or None to keep the whole image.
+    draft_scale: Reduction factor (1, 2, 4, or 8) that a JPEG decoder can
+      apply while decoding, because the next step scales the image down
+      at least that much.
+    steps: The steps that remain to be applied after loading.
+    """
+
+    box: tuple[int, int, int, int] | None
+    draft_scale: int
+    steps: tuple[Step, ...]
+
+
+def plan_load(steps: tuple[Step, ...], size: tuple[int, int], fmt: str) -> LoadPlan:
+    """
+    Returns a LoadPlan for an image of the given size and format (as
+    reported by Image.open, which only reads the header).
+
+    Leading crop steps are folded into a single crop box, so only one
+    crop is done before any copy of the pixels is made. If the next step
+    is crop_zoom and the source is a JPEG, a draft scale is chosen so that
+    the region that is kept still decodes at least as large as the zoom
+    target.
+    """
+    x1, y1, x2, y2 = 0, 0, size[0], size[1]
+    i = 0
+    while i < len(steps) and isinstance(steps[i], (CropStep, CropBoxStep)):
+        b = steps[i].get_crop_box((x2 - x1, y2 - y1))
+        x1, y1, x2, y2 = x1 + b[0], y1 + b[1], x1 + b[2], y1 + b[3]
+        i += 1
+
+    box = None if (x1, y1, x2, y2) == (0, 0, size[0], size[1]) else (x1, y1, x2, y2)
+
+    draft_scale = 1
+    if fmt == "JPEG" and i < len(steps) and isinstance(steps[i], CropZoomStep):
+        region_w, region_h = x2 - x1, y2 - y1
+        target_w = min(steps[i].size[0], region_w)
+        target_h = min(steps[i].size[1], region_h)
+        for scale in (8, 4, 2):
+            if region_w // scale >= target_w and region_h // scale >= target_h:
+                draft_scale = scale
+                break
+
+    return LoadPlan(box, draft_scale, steps[i:])
+
+
+def scale_box(box, scale, size):
+    """
+    Returns box (x1, y1, x2, y2) divided by scale, rounded outward so the
+    scaled box covers at least the same area, and limited to size.
+    """
+    x1, y1, x2, y2 = box
+    return (
+        x1 // scale,
+        y1 // scale,
+        min(-(-x2 // scale), size[0]),
+        min(-(-y2 // scale), size[1]),
+    )
+
+
+def load_image(src: Image.Image, steps: tuple[Step, ...], close: bool = True):
+    """
+    Loads the pixels of src, an image returned by Image.open, as planned
+    by plan_load(). Returns (img, steps) where img is the RGB image to
+    process and steps are the steps that remain to be applied.
+
+    If src is already RGB and is not cropped, src itself is returned
+    (loaded). Otherwise src is closed once the RGB image is made. If close
+    is False, src belongs to the caller: it is not draft scaled (which
+    would change it in place) and not closed, and a copy is returned
+    rather than src itself.
+    """
+    plan = plan_load(steps, src.size, src.format)
+    box = plan.box
+
+    if plan.draft_scale > 1 and close:
+        full_w, full_h = src.size
+        result = src.draft(
+            None, (full_w // plan.draft_scale, full_h // plan.draft_scale)
+        )
+        if result is not None:
+            scale = round(full_w / result[1][2])
+            if box is None:
+                box = (0, 0, full_w, full_h)
+            box = scale_box(box, scale, src.size)
+
+    #  Crop first, so only the region that is kept gets converted, and
+    #  convert only when the source is not already RGB.
+    img = src.crop(box) if box is not None else src
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    if img is src:
+        src.load()
+        if not close:
+            img = src.copy()
+    elif close:
+        #  Release the decoded source now rather than when it is collected.
+        src.close()
+
+    return img, plan.steps
+
+
 def get_args(arglist=None):
     """
     Return arguments parsed from the command line using argparse.
     """
     ap = argparse.ArgumentParser(
         description="Modifies images (crop, resize, and more) and saves the "
-        "modified versions as .jpg files. An options (plain text) file is "
-        "required to specify the process instructions and list of image "
-        "files."
+        "modified versions as .jpg files. An options (plain text) file "
+        "specifies the process instructions and list of image files."
     )
 
     ap.add_argument(
         "opt_file",
+        nargs="?",
         action="store",
         help="Name of 'options file' containing a list of process "
         "instructions and image file names, one per line.",
@@ -392,6 +1069,64 @@ def get_args(arglist=None):
         "the template comments are appended to the file.",
     )
 
+    ap.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        action="store",
+        help="Number of worker processes used to process the image files. "
+        "Use 0 for the number of CPUs. Overrides the 'workers:' setting in "
+        "the options file. The default is 1 (no worker processes).",
+    )
+
+    ap.add_argument(
+        "--profile",
+        dest="profile",
+        action="store_true",
+        help="Record the wall and CPU time of each stage (load, each process "
+        "instruction, save, GIF) for each file. A summary is printed and "
+        "the details are written, as JSON and CSV, to the output folder.",
+    )
+
+    ap.add_argument(
+        "--profile-memory",
+        dest="profile_memory",
+        action="store_true",
+        help="Same as --profile, and also record the peak memory allocated "
+        "by Python (tracemalloc) in each stage. Slower.",
+    )
+
+    ap.add_argument(
+        "--proc",
+        dest="proc_lines",
+        action="append",
+        metavar="LINE",
+        help="A line to add to the options, such as a process instruction "
+        "or a setting. May be used more than once, with or without an "
+        "options file.",
+    )
+
+    ap.add_argument(
+        "--stream",
+        dest="stream",
+        choices=STREAM_MODES,
+        help="Read images from stdin and write the results to stdout, "
+        "instead of using image files. 'single' is one image. 'length' is a "
+        "sequence of records, each an 8-byte big-endian length followed by "
+        "the image data. 'tar' is a tar file of images. Messages are "
+        "written to stderr.",
+    )
+
+    ap.add_argument(
+        "--plan",
+        dest="plan",
+        action="store_true",
+        help="Read only the header of each image file and report the output "
+        "sizes, warnings, and estimated work and memory for each file, "
+        "without processing or saving any images.",
+    )
+
     return ap.parse_args(arglist)
 
 
@@ -418,12 +1153,50 @@ def write_template_lines(file_path):
 
                     # output_suffix: "-crop"
 
-                    # output_format: JPG | PNG
+                    # output_format: JPG | PNG | WEBP | AVIF
+
+                    # --- Encoder settings. Settings given here override
+                    #     the preset. fast = Quick, larger previews.
+                    # encoder_preset: default | fast
+                    # jpeg_quality: 75
+                    # jpeg_progressive: no
+                    # jpeg_optimize: no
+                    # jpeg_subsampling: 4:4:4 | 4:2:2 | 4:2:0
+                    # png_compress_level: 6
+                    # png_optimize: no
+                    # webp_quality: 80
+                    # webp_method: 4
+                    # webp_lossless: no
+                    # avif_quality: 75
+                    # avif_speed: 6
 
                     # timestamp_mode:
                         # 1 = Add date_time to file name, to the second.
                         # 2 = Add date_time to file name, to the microsecond.
 
+                    # --- Number of worker processes (0 = number of CPUs).
+                    # workers: 1
+
+                    # --- Memory budget for the jobs the workers run at once
+                    #     (MB, or with a K, M, or G suffix). 0 = No limit.
+                    # max_memory: 0
+
+                    # --- Without worker processes, read this many source
+                    #     files ahead, and save results in write_threads
+                    #     background threads. 0 = Off.
+                    # prefetch: 0
+                    # write_threads: 2
+
+                    # --- Skip files unchanged since the last run. Requires
+                    #     output_folder. mtime = Compare modified time and
+                    #     size of source files. hash = Compare their content.
+                    # incremental: off | mtime | hash
+
+                    # --- Cache of results shared by runs into any output
+                    #     folder, limited to cache_max_mb megabytes.
+                    # cache_dir:
+                    # cache_max_mb: 1024
+
                     # --- Available process instructions:
 
                     # crop_from_left_top(width, height)
@@ -446,6 +1219,15 @@ def write_template_lines(file_path):
                     # --- border - specify RGB color
                     # border(width, red, green, blue)
 
+                    # --- border drawn over the edges of the image, keeping
+                    #     the image size (no resizing)
+                    # border_inset(width)
+                    # border_inset(width, red, green, blue)
+
+                    # --- border added around the image, making it larger
+                    # border_expand(width)
+                    # border_expand(width, red, green, blue)
+
                     # --- rounded border with transparent background
                     # rounded(radius, padding)
 
@@ -454,12 +1236,56 @@ def write_template_lines(file_path):
 
                     # animated_gif(duration_milliseconds)
 
+                    # --- Animated WebP instead of GIF (full color, smaller).
+                    # animated_webp(duration_milliseconds)
+
+                    # --- Palette for the animated GIF frames:
+                    #     frame = Separate palette for each frame (default).
+                    #     median | octree | libimagequant = One palette,
+                    #     made using the given method, shared by all frames.
+                    # gif_palette: frame
+
+                    # --- How to fit animated GIF frames that differ in size
+                    #     from the first frame: resize | crop | letterbox
+                    # gif_fit: resize
+
+                    # --- Filter for resizing GIF frames:
+                    #     nearest | bilinear | bicubic | lanczos
+                    # gif_resample: bicubic
+
+                    # --- Resize GIF frames in two passes when shrinking by
+                    #     more than this factor (faster, 2.0 or more is good).
+                    # gif_reducing_gap:
+
+                    # --- Filter for crop_zoom:
+                    #     nearest | bilinear | bicubic | lanczos
+                    # resample: bicubic
+
+                    # --- Resize in two passes in crop_zoom when shrinking
+                    #     by more than this factor (faster, 2.0 or more is good).
+                    # reducing_gap:
+
                     # text_footers("font-file-name", font-size, numbering)
                     #   numbering:
                     #     0 = No numbering
                     #     1 = Image number in footer.
                     #     2 = Image number of total in footer.
 
+                    # --- Output branches: the instructions above the first
+                    #     branch are done once, then each branch's own
+                    #     instructions, output_format, and output_suffix
+                    #     (default '-' plus the branch name) make an output.
+                    # branch: thumb
+                    # crop_zoom(200, 200)
+                    # branch: card
+                    # border_expand(20)
+                    # output_format: PNG
+
+                    # --- Order of the files from a glob pattern (such as
+                    #     photos/**/*.jpg) or folder in the list below:
+                    #     name | mtime | size | none (as found)
+                    # sort: name
+
                     #--- Put list of image files below, one per line:
                     #      If adding text_footers, put the text (caption) on the
                     #      line above the image file name, and begin that line
@@ -470,6 +1296,99 @@ def write_template_lines(file_path):
         )
 
 
+def get_opt_bool(opt_line: str) -> bool:
+    """
+    Returns the value of an option assignment as a bool. Raises
+    ImageSnipError if the value is not yes/no, true/false, on/off, or 1/0.
+    """
+    val = get_opt_str(opt_line).lower()
+    if val in ("yes", "true", "on", "1"):
+        return True
+    if val in ("no", "false", "off", "0"):
+        return False
+    raise ImageSnipError(f"Expected yes or no in '{opt_line.strip()}'")
+
+
+def get_save_kwargs(encode: EncodeOptions, save_format: str) -> dict:
+    """
+    Returns the keyword arguments for Image.save() per the encoder
+    settings, for the given Pillow format name.
+    """
+    kwargs = {}
+    if save_format == "JPEG":
+        if encode.jpeg_quality is not None:
+            kwargs["quality"] = encode.jpeg_quality
+        if encode.jpeg_subsampling is not None:
+            kwargs["subsampling"] = encode.jpeg_subsampling
+        kwargs["progressive"] = encode.jpeg_progressive
+        kwargs["optimize"] = encode.jpeg_optimize
+    elif save_format == "PNG":
+        if encode.png_compress_level is not None:
+            kwargs["compress_level"] = encode.png_compress_level
+        kwargs["optimize"] = encode.png_optimize
+    elif save_format == "WEBP":
+        if encode.webp_quality is not None:
+            kwargs["quality"] = encode.webp_quality
+        if encode.webp_method is not None:
+            kwargs["method"] = encode.webp_method
+        kwargs["lossless"] = encode.webp_lossless
+    elif save_format == "AVIF":
+        if encode.avif_quality is not None:
+            kwargs["quality"] = encode.avif_quality
+        if encode.avif_speed is not None:
+            kwargs["speed"] = encode.avif_speed
+    return kwargs
+
+
+def get_file_format(file_name: str) -> str | None:
+    """Returns the Pillow format name for the extension of file_name."""
+    return Image.registered_extensions().get(Path(file_name).suffix.lower())
+
+
+def get_opt_memory(opt_line: str) -> int:
+    """
+    Returns the value of a memory size option in bytes. The value is in
+    megabytes, or ends with K, M, or G (an optional B is ignored). Raises
+    ImageSnipError if it is not valid.
+    """
+    val = get_opt_str(opt_line).upper().removesuffix("B").strip()
+    unit = MEMORY_UNITS["M"]
+    if val[-1:] in MEMORY_UNITS:
+        unit = MEMORY_UNITS[val[-1]]
+        val = val[:-1].strip()
+    try:
+        size = float(val)
+    except ValueError:
+        size = -1
+    if size < 0:
+        raise ImageSnipError(f"Expected a memory size in '{opt_line.strip()}'")
+    return int(size * unit)
+
+
+def get_opt_int(opt_line: str) -> int:
+    """
+    Returns the value of an option assignment as an int. Raises
+    ImageSnipError if it is not a whole number.
+    """
+    try:
+        return int(get_opt_str(opt_line))
+    except ValueError:
+        raise ImageSnipError(
+            f"Expected a whole number in '{opt_line.strip()}'"
+        ) from None
+
+
+def get_opt_float(opt_line: str) -> float:
+    """
+    Returns the value of an option assignment as a float. Raises
+    ImageSnipError if it is not a number.
+    """
+    try:
+        return float(get_opt_str(opt_line))
+    except ValueError:
+        raise ImageSnipError(f"Expected a number in '{opt_line.strip()}'") from None
+
+
 def get_opt_str(opt_line: str) -> str:
     """
     Extracts the string to the left of the first colon in an option
@@ -483,64 +1402,360 @@ def get_opt_str(opt_line: str) -> str:
     return a[1].strip()
 
 
-def get_opts(arglist=None) -> AppOptions:
+def get_output_format(output_format: str) -> str:
     """
-    Return AppOptions (named tuple) set per the command line arguments
-    and the options file. Checks for missing paths and errors in the
-    options file.
+    Returns the output_format setting narrowed down to one of the
+    OUTPUT_FORMATS that this Pillow installation can write, or "" if not
+    set. Prints a warning and returns "PNG" for other values.
     """
+    if not output_format:
+        return ""
+    output_format = output_format.upper()
+    if output_format == "JPEG":
+        output_format = "JPG"
+    if output_format not in OUTPUT_FORMATS:
+        print(
+            f"WARNING: output_format '{output_format}' not valid. Defaulting to 'PNG'."
+        )
+        return "PNG"
+    feature = OUTPUT_FORMATS[output_format]
+    if feature and not features.check(feature):
+        print(
+            f"WARNING: output_format '{output_format}' is not available "
+            "in this Pillow installation. Defaulting to 'PNG'."
+        )
+        return "PNG"
+    return output_format
 
-    args = get_args(arglist)
-
-    opt_file = args.opt_file
-    if opt_file is None:
-        sys.stderr.write("ERROR: No options file specified.\n")
-        sys.exit(1)
-
-    if args.do_template:
-        write_template_lines(opt_file)
-        return None
-
-    if not Path(opt_file).exists():
-        sys.stderr.write(f"ERROR: File not found: '{opt_file}'\n")
-        sys.exit(1)
 
-    print(f"Reading options from '{opt_file}'.")
+def get_opt_suffix(opt_line: str) -> str:
+    """
+    Returns the value of an output_suffix setting, quotes removed, spaces
+    replaced with '-', and starting with '-' unless blank.
+    """
+    val = get_opt_str(opt_line).strip("'\"")
+    val = val.strip().replace(" ", "-")
+    if val and not val.startswith("-"):
+        val = "-" + val
+    return val
 
-    files: list[FileInfo] = []
-    proc_list = []
-    output_dir = ""
-    new_name = ""
-    output_format = ""
-    timestamp_mode = 0
-    gif_ms = 0
-    text_font = ""
-    text_size = 0
-    text_numbering = 0
-    output_suffix = "-crop"
 
+def make_branches(
+    branch_list: list[dict], output_format: str, **step_settings
+) -> tuple[tuple[Branch, ...], list[str]]:
+    """
+    Returns (branches, error_list) for the branch sections collected by
+    parse_opts_text(). A branch's output format defaults to the
+    output_format setting, and its suffix to '-' plus its name.
+    step_settings are passed to compile_steps().
+    """
+    branches = []
     error_list = []
-    caption = ""
+    seen = {}
+    for b in branch_list:
+        steps, step_errors = compile_steps(b["proc_list"], **step_settings)
+        error_list.extend(f"branch '{b['name']}': {e}" for e in step_errors)
+        fmt = get_output_format(b["output_format"]) or output_format
+        suffix = b["output_suffix"]
+        if suffix is None:
+            suffix = "-" + b["name"].replace(" ", "-")
+        if b["name"] in seen.values():
+            error_list.append(f"Duplicate branch name '{b['name']}'.")
+        elif (fmt, suffix) in seen:
+            error_list.append(
+                f"Branches '{seen[(fmt, suffix)]}' and '{b['name']}' have the "
+                "same output_suffix and output_format."
+            )
+        seen[(fmt, suffix)] = b["name"]
+        branches.append(Branch(b["name"], b["proc_list"], steps, fmt, suffix))
+    return tuple(branches), error_list
 
-    opt_text = Path(opt_file).read_text()
+
+def list_folder(folder: Path) -> dict[str, os.DirEntry]:
+    """
+    Returns {name: entry} for the entries in folder, or an empty dict if
+    the folder cannot be listed.
+    """
+    try:
+        with os.scandir(folder) as it:
+            return {entry.name: entry for entry in it}
+    except OSError:
+        return {}
+
+
+def check_folder_files(
+    folder: Path, names: list[str]
+) -> list[tuple[Path, bool] | None]:
+    """
+    Returns (resolved_path, is_folder) for each name in folder, or None for
+    a name that does not exist. The folder is listed once to find the
+    names in it. Symbolic links, and names not in the listing (which may
+    still exist, on a case-insensitive file system for example), are
+    checked one at a time.
+    """
+    folder = folder.resolve()
+    listing = list_folder(folder)
+    paths = []
+    for name in names:
+        entry = listing.get(name)
+        p = folder / name
+        if entry is None:
+            p = p.resolve()
+            paths.append((p, p.is_dir()) if p.exists() else None)
+            continue
+        if entry.is_symlink():
+            p = p.resolve()
+        paths.append((p, entry.is_dir()))
+    return paths
+
+
+def check_image_files(
+    file_lines: list[tuple[str, str]],
+) -> tuple[list[FileInfo | FilePattern], list[str]]:
+    """
+    Returns (files, error_list) for the (path, caption) image file lines
+    from the options file. The paths are grouped by folder, and the
+    folders are checked in a pool of threads, which is much faster than
+    checking each path in turn when there are many files on a network
+    drive. Files are kept in the order they are listed, and a message is
+    returned for each file that is not found.
+
+    Paths that are folders, and glob patterns, are returned as a
+    FilePattern, to be expanded when the files are processed. A line with
+    glob characters is only a pattern if no file or folder has that name.
+    """
+    folders: dict[Path, list[int]] = {}
+    names = []
+    for n, (s, _) in enumerate(file_lines):
+        p = Path(s).expanduser()
+        names.append(p.name)
+        folders.setdefault(p.parent, []).append(n)
+
+    found: list[tuple[Path, bool] | None] = [None] * len(file_lines)
+    with ThreadPoolExecutor(max_workers=CHECK_FILES_THREADS) as executor:
+        checks = {
+            folder: executor.submit(
+                check_folder_files, folder, [names[n] for n in nums]
+            )
+            for folder, nums in folders.items()
+        }
+        for folder, nums in folders.items():
+            for n, p in zip(nums, checks[folder].result(), strict=True):
+                found[n] = p
+
+    files = []
+    error_list = []
+    for (s, caption), p in zip(file_lines, found, strict=True):
+        if p is None and is_glob(s):
+            files.append(FilePattern(str(Path(s).expanduser()), caption))
+        elif p is None:
+            error_list.append(f"File not found: '{Path(s).expanduser().resolve()}'")
+        elif p[1]:
+            files.append(FilePattern(str(p[0]), caption, is_folder=True))
+        else:
+            files.append(FileInfo(p[0], caption))
+    return (files, error_list)
+
+
+def is_glob(s: str) -> bool:
+    return any(c in s for c in GLOB_CHARS)
+
+
+def iter_pattern_files(
+    pattern: str, is_folder: bool, sort: str, output_dir: Path | None = None
+) -> Iterator[Path]:
+    """
+    Yields the resolved paths of the files matching a glob pattern, or of
+    the image files in a folder (by file extension, not including
+    subfolders) if is_folder is True, ordered by the sort key (see
+    FILE_SORT_KEYS). Files a glob pattern finds in a default output folder
+    (crop_<date_time>), or in output_dir when it is a subfolder of the
+    pattern's base folder, are left out so earlier results are not
+    processed again. Files directly in the base folder (or in the folder)
+    are kept, since outputs written next to the sources are named apart
+    from them.
+    """
+    p = Path(pattern)
+    skip_dir = None
+    if not is_folder:
+        #  Path.glob() needs a relative pattern, from a folder with no
+        #  glob characters in its path.
+        n = next(i for i, part in enumerate(p.parts) if is_glob(part))
+        base = Path(*p.parts[:n]) if n else Path()
+        paths = (
+            m
+            for m in base.glob(str(Path(*p.parts[n:])))
+            if not in_default_output_folder(m.relative_to(base)) and m.is_file()
+        )
+        base_dir = base.resolve()
+        if (
+            output_dir
+            and output_dir != base_dir
+            and output_dir.is_relative_to(base_dir)
+        ):
+            skip_dir = output_dir
+    else:
+        image_exts = Image.registered_extensions()
+        paths = (
+            Path(entry.path)
+            for entry in iter_folder(p)
+            if entry.is_file() and Path(entry.name).suffix.lower() in image_exts
+        )
+
+    paths = (m.resolve() for m in paths)
+    if skip_dir is not None:
+        paths = (m for m in paths if not m.is_relative_to(skip_dir))
+
+    key = FILE_SORT_KEYS[sort]
+    if key is None:
+        yield from paths
+    else:
+        yield from sorted(paths, key=key)
+
+
+def in_default_output_folder(rel_path: Path) -> bool:
+    return any(DEFAULT_OUTPUT_FOLDER.fullmatch(part) for part in rel_path.parts[:-1])
+
+
+def iter_folder(folder: Path) -> Iterator[os.DirEntry]:
+    with os.scandir(folder) as it:
+        yield from it
+
+
+def iter_files(opts: AppOptions) -> Iterator[FileInfo]:
+    """
+    Yields a FileInfo for each image file in opts.files, expanding glob
+    patterns and folders as they are reached, so processing can start
+    before the whole list is known.
+    """
+    output_dir = None
+    if opts.output_dir:
+        output_dir = Path(opts.output_dir).expanduser().resolve()
+
+    for f in opts.files:
+        if isinstance(f, FileInfo):
+            yield f
+            continue
+        found = False
+        for p in iter_pattern_files(f.pattern, f.is_folder, opts.file_sort, output_dir):
+            found = True
+            yield FileInfo(p, f.text)
+        if not found:
+            print(f"WARNING: No image files found for '{f.pattern}'")
+
+
+def count_files(files: list[FileInfo | FilePattern]) -> int:
+    """
+    Returns the number of image files, or 0 if it is not known until the
+    glob patterns and folders in the list are expanded.
+    """
+    if any(isinstance(f, FilePattern) for f in files):
+        return 0
+    return len(files)
+
+
+def is_instruction_like(line: str) -> bool:
+    """
+    Returns True if line looks like a process instruction or setting
+    (see INSTRUCTION_LIKE) rather than an image file name, such as
+    'Photo (2).jpg'.
+    """
+    if Path(line).suffix.lower() in Image.registered_extensions():
+        return False
+    return INSTRUCTION_LIKE.match(line) is not None
+
+
+def parse_opts_text(
+    opt_text: str, check_files: bool = True
+) -> tuple[AppOptions, list[str]]:
+    """
+    Parse the text of an options file. Returns (opts, error_list) where
+    error_list holds a message for each line that is not valid.
+
+    Image file names are resolved and checked only if check_files is True.
+    Otherwise they are left out of opts.files and the filesystem is not
+    used, but a line that is not recognized and looks like an instruction
+    or setting (see is_instruction_like) is reported. Settings that come from
+    the command line (do_overwrite and profile) are left at their defaults.
+    """
+    files: list[FileInfo] = []
+    proc_list = []
+    output_dir = ""
+    new_name = ""
+    output_format = ""
+    timestamp_mode = 0
+    gif_ms = 0
+    text_font = ""
+    text_size = 0
+    text_numbering = 0
+    output_suffix = "-crop"
+    workers = 1
+    gif_palette = ""
+    gif_fit = "resize"
+    gif_resample = "bicubic"
+    gif_reducing_gap = None
+    resample = "bicubic"
+    reducing_gap = None
+    incremental = ""
+    cache_dir = ""
+    cache_max_mb = CACHE_MAX_MB
+    animation_format = "gif"
+    branch_list = []
+    max_memory = 0
+    prefetch = 0
+    write_threads = WRITE_THREADS
+    file_sort = "name"
+    encoder_preset = "default"
+    encode = {}
+
+    error_list = []
+    caption = ""
+    file_lines = []
 
     for line in opt_text.splitlines():
         s = line.strip().strip("'\"")
         if s and (not s.startswith("#")):
-            if s.startswith(("crop_", "border(", "rounded(")) and s.endswith(")"):
+            #  Process instructions after a 'branch:' line, and its
+            #  output_format and output_suffix, belong to that branch.
+            branch = branch_list[-1] if branch_list else None
+            procs = proc_list if branch is None else branch["proc_list"]
+
+            if s.startswith(("crop_", "border", "rounded(")) and s.endswith(")"):
                 #  Process instruction.
-                proc_list.append(s)
+                procs.append(s)
                 continue
 
             if s.startswith("text_footers(") and s.endswith(")"):
                 #  Instruction to add text to the bottom of the image.
-                text_font, text_size, text_numbering = extract_text_param(s)
-                proc_list.append(s)
+                try:
+                    text_font, text_size, text_numbering = extract_text_param(s)
+                except ImageSnipError as e:
+                    error_list.append(f"{e}")
+                procs.append(s)
+                continue
+
+            if s.startswith("branch:"):
+                #  Start of a named output branch.
+                name = get_opt_str(s).strip("'\"")
+                if not name:
+                    error_list.append("A branch needs a name.")
+                branch_list.append(
+                    {
+                        "name": name,
+                        "proc_list": [],
+                        "output_format": "",
+                        "output_suffix": None,
+                    }
+                )
                 continue
 
-            if s.startswith("animated_gif(") and s.endswith(")"):
-                #  Instruction to make an animated GIF.
-                gif_ms = extract_gif_param(s)
+            if s.startswith(("animated_gif(", "animated_webp(")) and s.endswith(")"):
+                #  Instruction to make an animated GIF or WebP.
+                try:
+                    gif_ms = extract_gif_param(s)
+                except ImageSnipError as e:
+                    error_list.append(f"{e}")
+                animation_format = s[len("animated_") : s.index("(")]
                 continue
 
             if s.startswith("output_folder:"):
@@ -554,22 +1769,161 @@ def get_opts(arglist=None) -> AppOptions:
                 continue
 
             if s.startswith("output_format:"):
-                #  Output format: JPG, JPEG, or PNG.
-                output_format = get_opt_str(s)
+                #  Output format: JPG, JPEG, PNG, WEBP, or AVIF.
+                if branch is None:
+                    output_format = get_opt_str(s)
+                else:
+                    branch["output_format"] = get_opt_str(s)
                 continue
 
             if s.startswith("timestamp_mode:"):
                 #  Mode for adding a timestamp to the output file name.
-                timestamp_mode = int(get_opt_str(s))
+                try:
+                    timestamp_mode = get_opt_int(s)
+                except ImageSnipError as e:
+                    error_list.append(f"{e}")
+                continue
+
+            if s.startswith("workers:"):
+                #  Number of worker processes.
+                try:
+                    workers = get_opt_int(s)
+                except ImageSnipError as e:
+                    error_list.append(f"{e}")
+                continue
+
+            if s.startswith("max_memory:"):
+                #  Memory budget for the jobs run at once by the workers.
+                try:
+                    max_memory = get_opt_memory(s)
+                except ImageSnipError as e:
+                    error_list.append(f"{e}")
+                continue
+
+            if s.startswith("prefetch:"):
+                #  Number of source files to read ahead.
+                try:
+                    prefetch = get_opt_int(s)
+                except ImageSnipError as e:
+                    error_list.append(f"{e}")
+                continue
+
+            if s.startswith("write_threads:"):
+                #  Number of threads saving results when prefetching.
+                try:
+                    write_threads = get_opt_int(s)
+                except ImageSnipError as e:
+                    error_list.append(f"{e}")
+                continue
+
+            if s.startswith("sort:"):
+                #  Order of the files from glob patterns and folders.
+                file_sort = get_opt_str(s).lower()
+                continue
+
+            if s.startswith("gif_palette:"):
+                #  Method for a palette shared by all animated GIF frames.
+                gif_palette = get_opt_str(s).lower()
+                continue
+
+            if s.startswith("gif_fit:"):
+                #  How to fit GIF frames to the size of the first frame.
+                gif_fit = get_opt_str(s).lower()
+                continue
+
+            if s.startswith("gif_resample:"):
+                #  Resampling filter used when resizing GIF frames.
+                gif_resample = get_opt_str(s).lower()
+                continue
+
+            if s.startswith("gif_reducing_gap:"):
+                #  Pillow reducing_gap used when resizing GIF frames.
+                try:
+                    gif_reducing_gap = get_opt_float(s)
+                except ImageSnipError as e:
+                    error_list.append(f"{e}")
+                continue
+
+            if s.startswith("resample:"):
+                #  Resampling filter used by crop_zoom.
+                resample = get_opt_str(s).lower()
+                continue
+
+            if s.startswith("reducing_gap:"):
+                #  Pillow reducing_gap used by crop_zoom.
+                try:
+                    reducing_gap = get_opt_float(s)
+                except ImageSnipError as e:
+                    error_list.append(f"{e}")
+                continue
+
+            if s.startswith("incremental:"):
+                #  Skip files that are unchanged since the last run.
+                incremental = get_opt_str(s).lower()
+                continue
+
+            if s.startswith("cache_dir:"):
+                #  Folder for the result cache shared across runs.
+                cache_dir = get_opt_str(s)
+                continue
+
+            if s.startswith("cache_max_mb:"):
+                #  Size limit of the result cache, in megabytes.
+                try:
+                    cache_max_mb = get_opt_int(s)
+                except ImageSnipError as e:
+                    error_list.append(f"{e}")
+                continue
+
+            if s.startswith("encoder_preset:"):
+                #  Encoder settings preset: default or fast.
+                encoder_preset = get_opt_str(s).lower()
+                continue
+
+            if s.startswith(
+                (
+                    "jpeg_quality:",
+                    "png_compress_level:",
+                    "webp_quality:",
+                    "webp_method:",
+                    "avif_quality:",
+                    "avif_speed:",
+                )
+            ):
+                #  Integer encoder settings.
+                name = s.split(":", 1)[0]
+                try:
+                    encode[name] = get_opt_int(s)
+                except ImageSnipError as e:
+                    error_list.append(f"{e}")
+                continue
+
+            if s.startswith(
+                (
+                    "jpeg_progressive:",
+                    "jpeg_optimize:",
+                    "png_optimize:",
+                    "webp_lossless:",
+                )
+            ):
+                #  Yes/no encoder settings.
+                try:
+                    encode[s.split(":", 1)[0]] = get_opt_bool(s)
+                except ImageSnipError as e:
+                    error_list.append(f"{e}")
+                continue
+
+            if s.startswith("jpeg_subsampling:"):
+                #  Chroma subsampling for JPEG output.
+                encode["jpeg_subsampling"] = get_opt_str(s)
                 continue
 
             if s.startswith("output_suffix:"):
                 #  Suffix to append to the output file stem.
-                val = get_opt_str(s).strip("'\"")
-                val = val.strip().replace(" ", "-")
-                if val and not val.startswith("-"):
-                    val = "-" + val
-                output_suffix = val
+                if branch is None:
+                    output_suffix = get_opt_suffix(s)
+                else:
+                    branch["output_suffix"] = get_opt_suffix(s)
                 continue
 
             if s.startswith(">"):
@@ -578,12 +1932,184 @@ def get_opts(arglist=None) -> AppOptions:
                 caption = s[1:].strip(" '\"")
                 continue
 
-            #  Image file path.
-            p = Path(s).expanduser().resolve()
-            if p.exists():
-                files.append(FileInfo(p, caption))
-            else:
-                error_list.append(f"File not found: '{p}'")
+            if not check_files:
+                if is_instruction_like(s):
+                    error_list.append(f"Unknown line in options file:\n'{s}'")
+                continue
+
+            #  Image file path, checked after all lines are read.
+            file_lines.append((s, caption))
+
+    if file_lines:
+        files, missing = check_image_files(file_lines)
+        error_list.extend(missing)
+
+    if gif_palette in ("", "frame"):
+        gif_palette = ""
+    elif gif_palette not in GIF_PALETTE_METHODS:
+        error_list.append(
+            f"gif_palette '{gif_palette}' not valid. Use one of: frame, "
+            f"{', '.join(GIF_PALETTE_METHODS)}."
+        )
+    elif gif_palette == "libimagequant" and not features.check_feature("libimagequant"):
+        print(
+            "WARNING: gif_palette 'libimagequant' is not available in this "
+            "Pillow installation. Using 'median'."
+        )
+        gif_palette = "median"
+
+    if gif_fit not in GIF_FIT_MODES:
+        error_list.append(
+            f"gif_fit '{gif_fit}' not valid. Use one of: {', '.join(GIF_FIT_MODES)}."
+        )
+
+    if gif_resample not in RESAMPLE_FILTERS:
+        error_list.append(
+            f"gif_resample '{gif_resample}' not valid. Use one of: "
+            f"{', '.join(RESAMPLE_FILTERS)}."
+        )
+
+    if gif_reducing_gap is not None and gif_reducing_gap < 1.0:
+        error_list.append("gif_reducing_gap must be 1.0 or greater.")
+
+    if resample not in RESAMPLE_FILTERS:
+        error_list.append(
+            f"resample '{resample}' not valid. Use one of: "
+            f"{', '.join(RESAMPLE_FILTERS)}."
+        )
+        resample = "bicubic"
+
+    if reducing_gap is not None and reducing_gap < 1.0:
+        error_list.append("reducing_gap must be 1.0 or greater.")
+
+    if encoder_preset not in ENCODER_PRESETS:
+        error_list.append(
+            f"encoder_preset '{encoder_preset}' not valid. Use one of: "
+            f"{', '.join(ENCODER_PRESETS)}."
+        )
+        encoder_preset = "default"
+    encode = EncodeOptions(**{**ENCODER_PRESETS[encoder_preset], **encode})
+
+    if encode.jpeg_quality is not None and not (1 <= encode.jpeg_quality <= 100):
+        error_list.append("jpeg_quality must be from 1 to 100.")
+
+    for name, low, high in (
+        ("png_compress_level", 0, 9),
+        ("webp_quality", 0, 100),
+        ("webp_method", 0, 6),
+        ("avif_quality", 0, 100),
+        ("avif_speed", 0, 10),
+    ):
+        val = getattr(encode, name)
+        if val is not None and not (low <= val <= high):
+            error_list.append(f"{name} must be from {low} to {high}.")
+
+    if encode.jpeg_subsampling is not None and (
+        encode.jpeg_subsampling not in JPEG_SUBSAMPLING
+    ):
+        error_list.append(
+            f"jpeg_subsampling '{encode.jpeg_subsampling}' not valid. Use one "
+            f"of: {', '.join(JPEG_SUBSAMPLING)}."
+        )
+
+    if file_sort not in FILE_SORT_KEYS:
+        error_list.append(
+            f"sort '{file_sort}' not valid. Use one of: {', '.join(FILE_SORT_KEYS)}."
+        )
+
+    if prefetch < 0:
+        error_list.append("prefetch must be 0 or greater.")
+
+    if write_threads < 1:
+        error_list.append("write_threads must be 1 or greater.")
+
+    if incremental == "off":
+        incremental = ""
+    elif incremental and incremental not in INCREMENTAL_MODES:
+        error_list.append(
+            f"incremental '{incremental}' not valid. Use one of: off, "
+            f"{', '.join(INCREMENTAL_MODES)}."
+        )
+
+    #  Parse and validate the process instructions once, before any
+    #  image is opened.
+    step_settings = {"resample": resample, "reducing_gap": reducing_gap}
+    steps, step_errors = compile_steps(proc_list, **step_settings)
+    error_list.extend(step_errors)
+
+    output_format = get_output_format(output_format)
+
+    branches, branch_errors = make_branches(branch_list, output_format, **step_settings)
+    error_list.extend(branch_errors)
+
+    return AppOptions(
+        opt_text,
+        proc_list,
+        files,
+        output_dir,
+        new_name,
+        output_format,
+        timestamp_mode,
+        gif_ms,
+        False,
+        text_font,
+        text_size,
+        text_numbering,
+        output_suffix,
+        workers,
+        steps,
+        gif_palette,
+        gif_fit,
+        gif_resample,
+        gif_reducing_gap,
+        PROFILE_OFF,
+        incremental=incremental,
+        cache_dir=cache_dir,
+        cache_max_mb=cache_max_mb,
+        encode=encode,
+        animation_format=animation_format,
+        branches=branches,
+        max_memory=max_memory,
+        prefetch=prefetch,
+        write_threads=write_threads,
+        file_sort=file_sort,
+        file_count=count_files(files),
+    ), error_list
+
+
+def get_opts(arglist=None) -> AppOptions:
+    """
+    Return AppOptions (named tuple) set per the command line arguments
+    and the options file. Checks for missing paths and errors in the
+    options file.
+    """
+
+    args = get_args(arglist)
+
+    opt_file = args.opt_file
+    if opt_file is None and (args.do_template or not args.proc_lines):
+        sys.stderr.write("ERROR: No options file specified.\n")
+        sys.exit(1)
+
+    if args.do_template:
+        write_template_lines(opt_file)
+        return None
+
+    opt_text = ""
+    if opt_file is not None:
+        if not Path(opt_file).exists():
+            sys.stderr.write(f"ERROR: File not found: '{opt_file}'\n")
+            sys.exit(1)
+
+        print(f"Reading options from '{opt_file}'.")
+
+        opt_text = Path(opt_file).read_text()
+
+    if args.proc_lines:
+        opt_text = "\n".join([opt_text, *args.proc_lines, ""])
+
+    #  Image file names are not used in --stream mode.
+    opts, error_list = parse_opts_text(opt_text, check_files=not args.stream)
 
     if error_list:
         sys.stderr.write("ERRORS:\n")
@@ -591,16 +2117,46 @@ def get_opts(arglist=None) -> AppOptions:
             sys.stderr.write(f"{msg}\n")
         sys.exit(1)
 
-    if not files:
+    if args.stream:
+        if args.plan:
+            sys.stderr.write("ERROR: --plan cannot be used with --stream.\n")
+            sys.exit(1)
+        if opts.branches and args.stream != "tar":
+            sys.stderr.write(
+                "ERROR: Output branches can only be used with '--stream tar'.\n"
+            )
+            sys.exit(1)
+        #  animated_gif is not used, so there must be process instructions.
+        if not (opts.proc_list or opts.branches):
+            sys.stderr.write(
+                "ERROR: No process instructions given for --stream mode.\n"
+            )
+            sys.exit(1)
+        #  Images are processed one at a time, in the order they arrive.
+        return opts._replace(stream=args.stream)
+
+    if not opts.files:
         sys.stderr.write("ERROR: Options file did not contain any image file names.\n")
         sys.exit(1)
 
-    if not (proc_list or gif_ms or text_font):
+    if not (opts.proc_list or opts.branches or opts.gif_ms or opts.text_font):
         sys.stderr.write(
             "\nERROR: Options file did not contain any process instructions.\n"
         )
         sys.exit(1)
 
+    output_dir = opts.output_dir
+    cache_dir = opts.cache_dir
+    if cache_dir:
+        #  The cache folder is made if it does not exist.
+        p = Path(cache_dir).expanduser().resolve()
+        p.mkdir(parents=True, exist_ok=True)
+        cache_dir = str(p)
+
+    if opts.incremental and not output_dir:
+        sys.stderr.write("ERROR: incremental mode requires an output_folder setting.\n")
+        sys.exit(1)
+
     if output_dir:
         p = Path(output_dir).expanduser().resolve()
         if not p.exists():
@@ -608,104 +2164,273 @@ def get_opts(arglist=None) -> AppOptions:
             sys.exit(1)
         output_dir = str(p)
 
-    if output_format:
-        #  If output_format was specified, narrow it down to JPG or PNG.
-        if output_format.upper() in ["JPG", "JPEG"]:
-            output_format = "JPG"
-        elif output_format.upper() == "PNG":
-            output_format = "PNG"
-        else:
-            print(
-                f"WARNING: output_format '{output_format}' not valid. "
-                "Defaulting to 'PNG'."
-            )
-            output_format = "PNG"
+    workers = opts.workers if args.jobs is None else args.jobs
 
-    return AppOptions(
-        opt_text,
-        proc_list,
-        files,
-        output_dir,
-        new_name,
-        output_format,
-        timestamp_mode,
-        gif_ms,
-        args.do_overwrite,
-        text_font,
-        text_size,
-        text_numbering,
-        output_suffix,
+    if args.profile_memory:
+        profile = PROFILE_MEMORY
+    elif args.profile:
+        profile = PROFILE_TIME
+    else:
+        profile = PROFILE_OFF
+
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    return opts._replace(
+        output_dir=output_dir,
+        cache_dir=cache_dir,
+        do_overwrite=args.do_overwrite,
+        workers=workers,
+        profile=profile,
+        plan=args.plan,
     )
 
 
-def make_gif(gif_ms, image_list, out_path):
+def to_gif_frame(img: Image.Image) -> Image.Image:
+    """
+    Returns img converted to a palette image for an animated GIF. This is
+    the same conversion the GIF encoder would do, done once per frame.
     """
-    Make an animated GIF from a list of image files.
+    if img.mode in ("1", "L", "P"):
+        return img
+    return img.convert("P", palette=Image.Palette.ADAPTIVE)
 
-    gif_ms: The display duration in milliseconds for each frame.
-    image_list: List of image file names.
-    out_path: Path to the output directory.
+
+def iter_source_images(files: list[FileInfo]) -> Iterator[Image.Image]:
     """
-    #  Use the first file in the list as the basis for the animated GIF
-    #  file name.
-    p = Path(image_list[0])
-    gif_path = (out_path / f"zgif-{p.name}").with_suffix(".gif")
+    Yields the source images, one at a time, for an animated GIF made
+    without any other process instructions.
+    """
+    for file_info in files:
+        print(f"Reading '{file_info.path}'")
+        with Image.open(file_info.path) as src:
+            src.load()
+            yield src
+
+
+def fit_frame(
+    img: Image.Image,
+    size: tuple[int, int],
+    fit: str = "resize",
+    resample: str = "bicubic",
+    reducing_gap: float | None = None,
+) -> Image.Image:
+    """
+    Returns img fitted to size for an animated GIF frame.
 
-    new_img = None
-    frames = []
-    first = True
+    fit: 'resize' stretches img to size. 'crop' scales img to cover size
+      and crops from the center. 'letterbox' scales img to fit inside size
+      and centers it on a black (or transparent) background.
+    resample: A RESAMPLE_FILTERS key.
+    reducing_gap: Passed to Image.resize.
+    """
+    if img.size == size:
+        return img
 
-    for file_name in image_list:
-        print(f"Reading '{Path(file_name)}'")
+    filt = RESAMPLE_FILTERS[resample]
 
-        img = Image.open(file_name)
-        # print(img.format, img.size, img.mode)
+    if fit == "crop":
+        #  Resample only the part of img that is kept after cropping. The
+        #  kept part may come out a pixel short of size, as get_new_size_zoom
+        #  rounds down, so it is resized to size in the same pass.
+        box, _ = get_zoom_box(img.size, size)
+        return img.resize(size, filt, box=box, reducing_gap=reducing_gap)
 
-        mem_buf = io.BytesIO()
+    if fit == "letterbox":
+        scale = min(size[0] / img.width, size[1] / img.height)
+        new_size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        img = img.resize(new_size, filt, reducing_gap=reducing_gap)
+        bg = Image.new(img.mode, size)
+        x1, y1, _, _ = crop_box_center(size, new_size)
+        bg.paste(img, (x1, y1))
+        return bg
 
-        #  Use Image.save to convert to GIF format in-memory.
-        img.save(mem_buf, format="GIF")
+    return img.resize(size, filt, reducing_gap=reducing_gap)
 
-        img = Image.open(mem_buf)
-        # print(img.format, img.size, img.mode)
 
-        if first:
+def iter_fitted_frames(images: Iterable[Image.Image], **kwargs):
+    """
+    Yields the images with each one fitted (see fit_frame) to the size of
+    the first image.
+    """
+    first_size = None
+    for img in images:
+        if first_size is None:
             first_size = img.size
-            new_img = img
-            first = False
-        else:
-            if img.size != first_size:
-                img.resize(first_size)
-            frames.append(img)
+        yield fit_frame(img, first_size, **kwargs)
+
+
+def make_gif_palette(images: list[Image.Image], method: str) -> Image.Image:
+    """
+    Returns a palette image, for Image.quantize(palette=...), made from a
+    sample of the images. Up to GIF_PALETTE_SAMPLE_FRAMES images, evenly
+    spaced, are reduced in size and their pixels combined into a single
+    image that is quantized using the given method (a GIF_PALETTE_METHODS
+    key).
+    """
+    step = max(1, -(-len(images) // GIF_PALETTE_SAMPLE_FRAMES))
+    pixels = []
+    for img in images[::step]:
+        small = img
+        scale = max(img.width, img.height) / GIF_PALETTE_SAMPLE_PX
+        if scale > 1:
+            new_size = (max(1, int(img.width / scale)), max(1, int(img.height / scale)))
+            #  NEAREST keeps the original colors rather than blending them.
+            small = img.resize(new_size, Image.Resampling.NEAREST)
+        pixels.append(small.convert("RGB").tobytes())
+
+    data = b"".join(pixels)
+    sample = Image.frombytes("RGB", (len(data) // 3, 1), data)
+
+    return sample.quantize(colors=256, method=GIF_PALETTE_METHODS[method])
+
+
+def iter_palette_frames(
+    images: deque[Image.Image], palette: Image.Image
+) -> Iterator[Image.Image]:
+    """
+    Yields the images quantized to the shared palette. Each image is
+    removed from the deque as it is quantized, so it can be released.
+    """
+    while images:
+        img = images.popleft()
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        yield img.quantize(palette=palette, dither=Image.Dither.NONE)
+
+
+def make_gif(
+    gif_ms: int,
+    images: Iterable[Image.Image],
+    gif_path: Path,
+    *,
+    palette_method: str = "",
+    fit: str = "resize",
+    resample: str = "bicubic",
+    reducing_gap: float | None = None,
+):
+    """
+    Make an animated GIF from images.
+
+    gif_ms: The display duration in milliseconds for each frame.
+    images: Images (in memory) to use as the frames. May be a generator,
+      so each image is converted to a palette frame, and can be released,
+      as the GIF is written. Pillow's GIF encoder still keeps every palette
+      frame (one byte per pixel) until the file is finished, so memory
+      grows with the number of frames, at about a third of the size of
+      the RGB images.
+    gif_path: Path of the GIF file to write.
+    palette_method: If set (a GIF_PALETTE_METHODS key), one palette is
+      made from a sample of all frames and every frame is mapped to it.
+      All frames are gathered first in that case. Otherwise, each frame
+      gets its own adaptive palette.
+    fit, resample, reducing_gap: How frames that differ in size from the
+      first frame are fitted to it (see fit_frame). Frames are fitted
+      before they are quantized.
+    """
+    images = iter_fitted_frames(
+        images, fit=fit, resample=resample, reducing_gap=reducing_gap
+    )
+
+    if palette_method:
+        images = deque(images)
+        if not images:
+            return
+        palette = make_gif_palette(list(images), palette_method)
+        frames = iter_palette_frames(images, palette)
+        #  Keep the encoder from trimming the shared palette per frame,
+        #  which would give each frame its own local palette again.
+        optimize = False
+    else:
+        frames = (to_gif_frame(img) for img in images)
+        optimize = True
+
+    first = next(frames, None)
+    if first is None:
+        return
 
     print(f"Writing '{gif_path}'")
 
-    if new_img is not None:
-        new_img.save(
-            str(gif_path),
-            format="GIF",
-            append_images=frames,
-            save_all=True,
-            duration=gif_ms,
-            loop=0,
-        )
+    first.save(
+        str(gif_path),
+        format="GIF",
+        append_images=frames,
+        save_all=True,
+        duration=gif_ms,
+        loop=0,
+        optimize=optimize,
+    )
+
+
+def make_webp(
+    frame_ms: int,
+    images: Iterable[Image.Image],
+    webp_path: Path,
+    *,
+    encode: EncodeOptions | None = None,
+    fit: str = "resize",
+    resample: str = "bicubic",
+    reducing_gap: float | None = None,
+):
+    """
+    Make an animated WebP from images. The frames keep their full color,
+    so there is no palette to make as there is for a GIF.
+
+    frame_ms: The display duration in milliseconds for each frame.
+    images: Images (in memory) to use as the frames. May be a generator.
+    webp_path: Path of the WebP file to write.
+    encode: The webp_* encoder settings are used (Pillow's defaults if
+      None).
+    fit, resample, reducing_gap: How frames that differ in size from the
+      first frame are fitted to it (see fit_frame).
+    """
+    frames = iter_fitted_frames(
+        images, fit=fit, resample=resample, reducing_gap=reducing_gap
+    )
 
+    first = next(frames, None)
+    if first is None:
+        return
 
+    print(f"Writing '{webp_path}'")
+
+    first.save(
+        str(webp_path),
+        format="WEBP",
+        append_images=frames,
+        save_all=True,
+        duration=frame_ms,
+        loop=0,
+        **get_save_kwargs(encode or EncodeOptions(), "WEBP"),
+    )
+
+
+@lru_cache(maxsize=16)
 def get_est_text_ht(font, font_size, pad_px=20):
     """
     Return the estimeted height in pixels needed to display text using the
     given font and font size.
-    ImageDraw.Draw has a textlength() method, but no textheight() method,
-    so get the length of the letter "M" and use that to estimate the height.
-    Some padding is added to the height.
+    Fonts have a getlength() method, but no height method that matches
+    the length, so get the length of the letter "M" and use that to
+    estimate the height. Some padding is added to the height.
+    The result is cached, since the font and size are the same for every
+    image in a run.
     """
-    temp_img = Image.new("RGB", (400, 400))
-    draw = ImageDraw.Draw(temp_img)
-    font_len = int(draw.textlength("M", font=font, font_size=font_size))
+    font_len = int(font.getlength("M"))
 
     return font_len + pad_px
 
 
+@lru_cache(maxsize=8)
+def get_footer_band(width: int, height: int) -> Image.Image:
+    """
+    Return a blank footer band, filled with the footer background color.
+    The band is cached and reused for images of the same width. It must
+    not be modified.
+    """
+    return Image.new("RGB", (width, height), FOOTER_BACKGROUND_RGB)
+
+
 def add_text_footer(image, text, font, font_size, numbering, file_num, file_count):
     """
     Add a footer with text to an image.
@@ -722,17 +2447,18 @@ def add_text_footer(image, text, font, font_size, numbering, file_num, file_coun
     """
 
     est_ht = get_est_text_ht(font, font_size)
-    new_h = int(image.height + est_ht + (FOOTER_PAD_PX * 2))
+    band_h = int(est_ht + (FOOTER_PAD_PX * 2))
 
-    im = Image.new("RGB", (image.width, new_h), FOOTER_BACKGROUND_RGB)
+    im = Image.new("RGB", (image.width, image.height + band_h))
     im.paste(image, (0, 0))
+    im.paste(get_footer_band(image.width, band_h), (0, image.height))
 
     #  If the numbering option is 1 or 2 add the image number to the text,
-    #  even if text is empty.
-    if numbering == 1:
-        text = f"{text}  ({file_num})"
-    elif numbering == 2:
+    #  even if text is empty. file_count is 0 if the count is not known.
+    if numbering == 2 and file_count:
         text = f"{text}  ({file_num}/{file_count})"
+    elif numbering:
+        text = f"{text}  ({file_num})"
 
     if text:
         draw = ImageDraw.Draw(im)
@@ -742,8 +2468,7 @@ def add_text_footer(image, text, font, font_size, numbering, file_num, file_coun
     return im
 
 
-def add_border(src: Image.Image, proc):
-    w, rgb = extract_border_attrs(proc)
+def add_border(src: Image.Image, w: int, rgb: tuple[int, int, int]) -> Image.Image:
     ww = w + w
     new_size = (src.width - ww, src.height - ww)
 
@@ -756,56 +2481,1315 @@ def add_border(src: Image.Image, proc):
     return img
 
 
-def add_rounded_border(src: Image.Image, proc) -> Image.Image:
-    corner_radius, padding, rgb = extract_rounded_attrs(proc)
+def get_fill_color(img: Image.Image, rgb: tuple[int, int, int]):
+    """Return rgb as a fill color for the mode of img."""
+    if img.mode == "RGBA":
+        return (*rgb, 255)
+    return rgb
 
-    if rgb is None:
-        bg_img = Image.new("RGBA", src.size, (0, 0, 0, 0))
-    else:
-        bg_img = Image.new("RGB", src.size, rgb)
 
-    mask = Image.new("L", src.size, 0)
+def add_border_inset(
+    src: Image.Image, w: int, rgb: tuple[int, int, int]
+) -> Image.Image:
+    """
+    Return a copy of src with a border of width w filled over its edges.
+    The size does not change and nothing is resampled.
+    """
+    img = src.copy()
+    fill = get_fill_color(img, rgb)
+    width, height = img.size
+    w = min(w, width, height)
+
+    img.paste(fill, (0, 0, width, w))
+    img.paste(fill, (0, height - w, width, height))
+    img.paste(fill, (0, w, w, height - w))
+    img.paste(fill, (width - w, w, width, height - w))
+
+    return img
+
+
+def add_border_expand(
+    src: Image.Image, w: int, rgb: tuple[int, int, int]
+) -> Image.Image:
+    """
+    Return src with a border of width w added around it, so the image is
+    2 * w wider and taller. Nothing is resampled.
+    """
+    return ImageOps.expand(src, border=w, fill=get_fill_color(src, rgb))
+
+
+def make_rounded_mask(size, radius, padding, blur):
+    """
+    Return an 'L' mask with a blurred, rounded rectangle (255) inset by
+    padding on a 0 background. Draws and blurs the whole mask.
+    """
+    mask = Image.new("L", size, 0)
 
     draw = ImageDraw.Draw(mask)
 
     draw.rounded_rectangle(
-        (padding, padding, src.size[0] - padding, src.size[1] - padding),
-        radius=corner_radius,
+        (padding, padding, size[0] - padding, size[1] - padding),
+        radius=radius,
         fill=255,
     )
 
+    return mask.filter(ImageFilter.GaussianBlur(radius=blur))
+
+
+@lru_cache(maxsize=16)
+def get_rounded_mask(size, radius, padding, blur):
+    """
+    Return the same mask as make_rounded_mask, built from the corners.
+
+    Only a small mask, two tiles wide and high, is drawn and blurred. Its
+    four quarters are the corners of the full mask, and its middle row and
+    column are the blurred profile of the straight edges, which is
+    stretched along each side. The inside is a solid fill. So the cost of
+    the blur depends on the radius and padding, not the image size.
+
+    Masks are cached (least recently used are dropped) since the images
+    in a batch are often the same size. The returned mask must not be
+    modified.
+    """
+    #  Each tile must reach past the corner curve by more than the blur.
+    tile = padding + radius + int(blur * 3) + 2
+    width, height = size
+
+    if width < tile * 2 or height < tile * 2:
+        return make_rounded_mask(size, radius, padding, blur)
+
+    t2 = tile * 2
+    small = make_rounded_mask((t2, t2), radius, padding, blur)
+
+    mask = Image.new("L", size, 255)
+
+    #  Corners.
+    mask.paste(small.crop((0, 0, tile, tile)), (0, 0))
+    mask.paste(small.crop((tile, 0, t2, tile)), (width - tile, 0))
+    mask.paste(small.crop((0, tile, tile, t2)), (0, height - tile))
+    mask.paste(small.crop((tile, tile, t2, t2)), (width - tile, height - tile))
+
+    #  Edges between the corners.
+    inner_w = width - t2
+    inner_h = height - t2
+    if inner_w:
+        edge = small.crop((tile, 0, tile + 1, tile))
+        mask.paste(edge.resize((inner_w, tile), Image.Resampling.NEAREST), (tile, 0))
+        edge = small.crop((tile, tile, tile + 1, t2))
+        mask.paste(
+            edge.resize((inner_w, tile), Image.Resampling.NEAREST),
+            (tile, height - tile),
+        )
+    if inner_h:
+        edge = small.crop((0, tile, tile, tile + 1))
+        mask.paste(edge.resize((tile, inner_h), Image.Resampling.NEAREST), (0, tile))
+        edge = small.crop((tile, tile, t2, tile + 1))
+        mask.paste(
+            edge.resize((tile, inner_h), Image.Resampling.NEAREST),
+            (width - tile, tile),
+        )
+
+    return mask
+
+
+def add_rounded_border(
+    src: Image.Image,
+    corner_radius: int,
+    padding: int,
+    rgb: tuple[int, int, int] | None,
+) -> Image.Image:
+    if rgb is None:
+        bg_img = Image.new("RGBA", src.size, (0, 0, 0, 0))
+    else:
+        bg_img = Image.new("RGB", src.size, rgb)
+
     blur_radius = 1  # Smooth the corners a bit.
-    mask = mask.filter(ImageFilter.GaussianBlur(radius=blur_radius))
+    mask = get_rounded_mask(src.size, corner_radius, padding, blur_radius)
 
     return Image.composite(src, bg_img, mask)
 
 
-def main(arglist=None):
-    print(f"\n{app_label}\n")
+@lru_cache(maxsize=4)
+def load_font(text_font: str, text_size: int):
+    """
+    Return the font to use for text footers. The font is loaded once per
+    process, so each worker process loads it only on first use.
+    """
+    if text_font.lower().endswith(".ttf"):
+        return ImageFont.truetype(text_font, text_size)
+    return ImageFont.load(text_font)
 
-    opts = get_opts(arglist)
 
-    if opts is None:
-        #  Is None if write_template_lines was called.
-        return 0
+def get_save_format(output_format: str, src_format: str | None) -> str:
+    """
+    Returns the Pillow format name used to encode an image that is not
+    saved to a named file. Uses the source format if output_format is not
+    set, or PNG if Pillow cannot write the source format.
+    """
+    if output_format:
+        return "JPEG" if output_format == "JPG" else output_format
+    if src_format in Image.SAVE:
+        return src_format
+    return "PNG"
+
+
+class Pipeline:
+    """
+    The process instructions from an options text, applied to images in
+    memory. This is the same processing main() does for each image file,
+    without reading or writing any image files. File names, output
+    settings, and animated_gif in the options text are not used. Use
+    run_branches() when the text declares output branches.
+
+    Example:
+
+        pipeline = Pipeline.from_text("crop_from_center(800, 600)\nborder(4)")
+        img = pipeline.run(Image.open(...))
+        data = pipeline.run_bytes(request_body)
+    """
+
+    def __init__(self, opts: AppOptions):
+        self.opts = opts
+
+    @classmethod
+    def from_text(cls, opts_text: str) -> Pipeline:
+        """
+        Return a Pipeline for the options text. Raises ImageSnipError,
+        with a line for each problem, if the text is not valid.
+        """
+        opts, error_list = parse_opts_text(opts_text, check_files=False)
+        if error_list:
+            raise ImageSnipError("\n".join(error_list))
+        return cls(opts)
+
+    @property
+    def steps(self) -> tuple[Step, ...]:
+        return self.opts.steps
+
+    def process(
+        self,
+        src: Image.Image,
+        file_info: FileInfo,
+        file_num: int,
+        file_count: int,
+        *,
+        timer: StageTimer | None = None,
+        close: bool = True,
+    ) -> Image.Image:
+        """
+        Apply the shared steps to src, an opened image. The stages are
+        recorded by timer, if given. src is closed once loaded unless close
+        is False, in which case src belongs to the caller and is left as it
+        is (see load_image).
+        """
+        if timer is None:
+            timer = StageTimer(file_num, PROFILE_OFF)
+
+        with timer.stage("load"):
+            img, steps = load_image(src, self.opts.steps, close)
+
+        ctx = self.get_context(file_info, file_num, file_count)
+
+        return self.apply(img, steps, ctx, timer)
+
+    def get_context(
+        self, file_info: FileInfo, file_num: int, file_count: int
+    ) -> ProcContext:
+        opts = self.opts
+        font = load_font(opts.text_font, opts.text_size) if opts.text_font else None
+        return ProcContext(file_info, file_num, file_count, font)
+
+    def apply(
+        self,
+        img: Image.Image,
+        steps: tuple[Step, ...],
+        ctx: ProcContext,
+        timer: StageTimer,
+        label: str = "",
+    ) -> Image.Image:
+        """
+        Apply steps to img. Each is timed as a stage named by its
+        instruction, after label (the branch name, for branch steps).
+        Steps return new images, so img can be forked to several branches.
+        """
+        for step in steps:
+            with timer.stage(f"{label}{step.proc}"):
+                img = step.apply(img, ctx)
+        return img
+
+    def run(
+        self,
+        image: Image.Image | bytes,
+        text: str = "",
+        file_num: int = 1,
+        file_count: int = 1,
+    ) -> Image.Image:
+        """
+        Return a new image with the steps applied to image, a PIL Image or
+        the encoded bytes of an image file. text, file_num, and file_count
+        are used by text_footers for the caption and numbering.
+        """
+        file_info = FileInfo(None, text)
+        if isinstance(image, Image.Image):
+            return self.process(image, file_info, file_num, file_count, close=False)
+
+        with Image.open(io.BytesIO(image)) as src:
+            return self.process(src, file_info, file_num, file_count)
+
+    def run_bytes(
+        self, data: bytes, text: str = "", file_num: int = 1, file_count: int = 1
+    ) -> bytes:
+        """
+        Like run(), for encoded image data. The result is encoded per
+        output_format, or in the format of the source if output_format is
+        not set.
+        """
+        with Image.open(io.BytesIO(data)) as src:
+            save_format = get_save_format(self.opts.output_format, src.format)
+            img = self.process(src, FileInfo(None, text), file_num, file_count)
+        return self.encode(img, save_format)
+
+    def run_branches(
+        self,
+        image: Image.Image | bytes,
+        text: str = "",
+        file_num: int = 1,
+        file_count: int = 1,
+    ) -> dict[str, Image.Image]:
+        """
+        Like run(), but returns an image for each output branch, by branch
+        name. The shared steps are applied once.
+        """
+        img = self.run(image, text, file_num, file_count)
+        ctx = self.get_context(FileInfo(None, text), file_num, file_count)
+        timer = StageTimer(file_num, PROFILE_OFF)
+        return {
+            b.name: self.apply(img, b.steps, ctx, timer) for b in self.opts.branches
+        }
+
+    def encode(self, img: Image.Image, save_format: str) -> bytes:
+        """Returns img encoded per save_format and the encoder settings."""
+        out = io.BytesIO()
+        img.save(
+            out, format=save_format, **get_save_kwargs(self.opts.encode, save_format)
+        )
+        return out.getvalue()
+
+
+def clear_output_path(opts: AppOptions, file_info: FileInfo, file_name: str):
+    """
+    Removes an existing output file if overwriting is allowed. Raises
+    ImageSnipError if it is not, or if the file is the source file.
+    """
+    p = Path(file_name)
+    if p.exists():
+        if opts.do_overwrite:
+            if file_info.path.samefile(p):
+                raise ImageSnipError(f"Cannot overwrite original file:\n'{p}'")
+            p.unlink()
+        else:
+            raise ImageSnipError(f"Cannot replace exising file:\n'{p}'")
+
+
+def get_outputs(
+    opts: AppOptions, file_num: int, file_info: FileInfo, file_name: str
+) -> list[tuple[str, Branch | None]]:
+    """
+    Returns (output_file_name, branch) for each output of a job. Without
+    branches there is one output, file_name. With branches, each output
+    is named as file_name would be, in the branch's output format, with
+    the branch's suffix added to the stem.
+    """
+    if not opts.branches:
+        return [(file_name, None)]
+
+    out_path = Path(file_name).parent
+    outputs = []
+    for b in opts.branches:
+        base = Path(
+            get_output_name(
+                out_path,
+                file_info.path,
+                opts._replace(output_format=b.output_format, output_suffix=""),
+                file_num,
+            )
+        )
+        name = base.with_name(f"{base.stem}{b.output_suffix}{base.suffix}")
+        outputs.append((str(name), b))
+    return outputs
+
+
+def get_cache_paths(
+    opts: AppOptions,
+    file_num: int,
+    file_info: FileInfo,
+    outputs: list[tuple[str, Branch | None]],
+) -> list[Path]:
+    """
+    Returns the path of the cached result for each output of a job. The
+    name is a hash of the source content and the steps (see get_job_key),
+    and of the branch steps, with the output file extension, which
+    selects the encoder.
+    """
+    job_key = get_job_key(opts, file_num, file_info, "hash")
+    paths = []
+    for file_name, branch in outputs:
+        key = job_key
+        if branch is not None:
+            steps_key = get_steps_key(branch.steps)
+            key = hashlib.sha256(f"{job_key}{steps_key}".encode()).hexdigest()
+        suffix = Path(file_name).suffix.lower()
+        paths.append(Path(opts.cache_dir) / key[:2] / f"{key}{suffix}")
+    return paths
+
+
+def copy_from_cache(cached: Path, file_name: str):
+    """
+    Hard-links (or copies, if a link cannot be made) the cached result to
+    file_name. The cached file's modified time is updated, as the cache
+    is pruned by least recent use.
+    """
+    try:
+        os.link(cached, file_name)
+    except OSError:
+        shutil.copyfile(cached, file_name)
+    os.utime(cached)
+
+
+def add_to_cache(file_name: str, cached: Path):
+    """
+    Copies a new output file into the cache. The copy is renamed into
+    place, so other processes never see a partial file. A failure to
+    write the cache does not fail the job.
+    """
+    tmp = cached.with_name(f".{cached.name}.{os.getpid()}")
+    try:
+        cached.parent.mkdir(exist_ok=True)
+        shutil.copyfile(file_name, tmp)
+        tmp.replace(cached)
+    except OSError as e:
+        print(f"WARNING: Cannot add to cache: {e}")
+        tmp.unlink(missing_ok=True)
+
+
+def prune_cache(cache_dir: Path, max_mb: int):
+    """
+    Deletes the least recently used results until the cache is no larger
+    than max_mb megabytes.
+    """
+    entries = []
+    for p in cache_dir.glob("*/*"):
+        if not p.name.startswith("."):
+            st = p.stat()
+            entries.append((st.st_mtime_ns, st.st_size, p))
+
+    total = sum(size for _, size, _ in entries)
+    limit = max_mb * 1024 * 1024
+    removed = 0
+    for _, size, p in sorted(entries):
+        if total <= limit:
+            break
+        p.unlink(missing_ok=True)
+        total -= size
+        removed += 1
+
+    if removed:
+        print(f"Removed {removed} file(s) from the cache.")
+
+
+def process_file(
+    opts: AppOptions,
+    file_num: int,
+    file_info: FileInfo,
+    file_name: str,
+    data: bytes | None = None,
+) -> FileResult:
+    """
+    Apply the process instructions to one image file and save the result
+    as file_name. Runs in a worker process when opts.workers > 1, so errors
+    are returned in the FileResult instead of exiting. data is the content
+    of the source file, if it has already been read.
+    """
+    timer = StageTimer(file_num, opts.profile)
+    try:
+        result = process_outputs(opts, file_num, file_info, file_name, timer, data=data)
+    except Exception as e:
+        error = get_job_error(file_info, e)
+        return FileResult(file_num, "", error, None, tuple(timer.records))
+
+    if isinstance(result, FileResult):
+        return result
+    return save_outputs(opts, result)
+
+
+def get_job_error(file_info: FileInfo, e: Exception) -> str:
+    """
+    Returns the message for an exception that failed a job. Unexpected
+    exceptions (not one of JOB_ERRORS) are named, with the file, so a
+    failure in one file is reported along with the others instead of
+    stopping the run.
+    """
+    if isinstance(e, JOB_ERRORS):
+        return f"{e}"
+    return f"'{file_info.path}': {type(e).__name__}: {e}"
 
+
+#  The options for the jobs run in a worker process. They are sent once,
+#  when the worker starts (see init_worker), rather than with every job.
+worker_opts: AppOptions | None = None
+
+
+def init_worker(opts: AppOptions):
+    global worker_opts  # noqa: PLW0603
+    worker_opts = opts
+
+
+def process_worker_file(file_num: int, file_info: FileInfo, file_name: str):
+    """Runs process_file() in a worker process started with init_worker."""
+    return process_file(worker_opts, file_num, file_info, file_name)
+
+
+def process_outputs(
+    opts: AppOptions,
+    file_num: int,
+    file_info: FileInfo,
+    file_name: str,
+    timer: StageTimer,
+    *,
+    data: bytes | None = None,
+) -> FileOutputs | FileResult:
+    """
+    Apply the process instructions to one image file, returning the
+    images to be saved by save_outputs(). If the results are all in the
+    cache, they are copied to the output files, and the FileResult is
+    returned instead. Raises an exception if the job fails.
+    """
+    print(f"Reading '{file_info.path}'")
+
+    outputs = get_outputs(opts, file_num, file_info, file_name)
+    #  The first output is the file name in the result, and is the
+    #  frame for the animated GIF.
+    first_name = outputs[0][0]
+
+    cached = [None] * len(outputs)
+    if opts.cache_dir:
+        cached = get_cache_paths(opts, file_num, file_info, outputs)
+        if all(p.exists() for p in cached):
+            for (name, _), cached_path in zip(outputs, cached, strict=True):
+                print(f"Using cached result for '{name}'")
+                clear_output_path(opts, file_info, name)
+                with timer.stage("cache"):
+                    copy_from_cache(cached_path, name)
+            img = None
+            if opts.gif_ms > 0:
+                with Image.open(first_name) as src:
+                    img = src.convert("RGB")
+            return FileResult(file_num, first_name, "", img, tuple(timer.records))
+
+    pipeline = Pipeline(opts)
+    file_count = opts.file_count
+    src_file = file_info.path if data is None else io.BytesIO(data)
+    with Image.open(src_file) as src:
+        shared = pipeline.process(src, file_info, file_num, file_count, timer=timer)
+
+    ctx = pipeline.get_context(file_info, file_num, file_count)
+    images = []
+    for (name, branch), cached_path in zip(outputs, cached, strict=True):
+        img = shared
+        if branch is not None:
+            img = pipeline.apply(shared, branch.steps, ctx, timer, f"{branch.name}: ")
+        images.append((name, img, cached_path))
+
+    return FileOutputs(file_num, file_info, images, timer)
+
+
+def save_outputs(opts: AppOptions, file_outputs: FileOutputs) -> FileResult:
+    """
+    Save the images from process_outputs(), and add them to the cache.
+    Errors are returned in the FileResult.
+    """
+    file_num, file_info, outputs, timer = file_outputs
+    try:
+        for name, img, cached_path in outputs:
+            print(f"Saving '{name}'")
+
+            clear_output_path(opts, file_info, name)
+
+            with timer.stage("save"):
+                img.save(name, **get_save_kwargs(opts.encode, get_file_format(name)))
+
+            if cached_path is not None:
+                add_to_cache(name, cached_path)
+
+    except Exception as e:
+        error = get_job_error(file_info, e)
+        return FileResult(file_num, "", error, None, tuple(timer.records))
+
+    #  The processed image is returned for the animated GIF frames.
+    first_name, first_img, _ = outputs[0]
+    return FileResult(
+        file_num,
+        first_name,
+        "",
+        first_img if opts.gif_ms > 0 else None,
+        tuple(timer.records),
+    )
+
+
+def get_jobs(
+    opts: AppOptions, out_path: Path, files: Iterable[FileInfo] | None = None
+) -> Iterator[tuple[int, FileInfo, str]]:
+    """
+    Yields (file_num, file_info, output_file_name) for the image files
+    (from iter_files, if files is not given). Output file names are
+    assigned here, in the order the files are listed, so numbering does
+    not depend on which worker finishes first.
+    """
+    if files is None:
+        files = iter_files(opts)
+    for file_num, file_info in enumerate(files, start=1):
+        yield (
+            file_num,
+            file_info,
+            get_output_name(out_path, file_info.path, opts, file_num),
+        )
+
+
+def get_job_memory(file_info: FileInfo) -> tuple[int, bool]:
+    """
+    Returns (estimated_bytes, run_alone) for processing an image file,
+    using the size and bands from its header (the image is not decoded).
+    run_alone is True if the image has more than Image.MAX_IMAGE_PIXELS
+    pixels. If the header cannot be read, returns (0, False) and the
+    error is reported when the job runs.
+    """
+    try:
+        size, bands, _ = read_image_header(file_info.path)
+    except (OSError, Image.DecompressionBombError):
+        return (0, False)
+
+    pixels = size[0] * size[1]
+    alone = Image.MAX_IMAGE_PIXELS is not None and pixels > Image.MAX_IMAGE_PIXELS
+    return (estimate_job_memory(size, bands), alone)
+
+
+def read_image_header(path: Path) -> tuple[tuple[int, int], int, str]:
+    """
+    Returns (size, bands, format) for an image file. Image.open only reads
+    the header, so no pixels are decoded.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+        with Image.open(path) as img:
+            return (img.size, len(img.getbands()), img.format)
+
+
+def estimate_job_memory(size: tuple[int, int], bands: int) -> int:
+    """
+    Returns the estimated bytes needed to process an image of the given
+    size and number of bands: the decoded image and its working copies.
+    """
+    return size[0] * size[1] * max(bands, 3) * JOB_MEMORY_FACTOR
+
+
+def process_files(
+    opts: AppOptions, jobs: Iterable[tuple[int, FileInfo, str]]
+) -> Iterator[FileResult]:
+    """
+    Process the jobs (from get_jobs), using a pool of worker processes if
+    opts.workers is greater than 1. Results are yielded in job order.
+    """
+    #  No more workers than jobs. Only the first jobs are taken to count
+    #  them, as the rest may not have been found yet.
+    jobs = iter(jobs)
+    first_jobs = list(islice(jobs, opts.workers))
+    workers = min(opts.workers, len(first_jobs))
+    jobs = chain(first_jobs, jobs)
+
+    if workers <= 1:
+        if opts.prefetch:
+            yield from process_files_prefetch(opts, jobs)
+            return
+        for job in jobs:
+            yield process_file(opts, *job)
+        return
+
+    print(f"Using {workers} worker processes.")
+    if opts.max_memory:
+        print(f"Memory budget: {opts.max_memory // MEMORY_UNITS['M']} MB.")
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(opts,)
+    ) as executor:
+        #  Keep a limited number of jobs in flight, so finished results
+        #  (which may hold images for the GIF) do not pile up. With a
+        #  memory budget, jobs are started in order, each only when its
+        #  estimated memory fits in the budget with the jobs in flight, and
+        #  a job that does not fit in the budget, or that is larger than
+        #  Image.MAX_IMAGE_PIXELS, runs alone. Without a budget the headers
+        #  are not read here, so no file is opened before its job starts.
+        pending = deque()
+        in_use = 0
+        for job in jobs:
+            need, alone = get_job_memory(job[1]) if opts.max_memory else (0, False)
+            if alone or (opts.max_memory and need > opts.max_memory):
+                alone = True
+                print(f"Large image, running alone: '{job[1].path}'")
+            while pending and (
+                len(pending) >= workers * 2
+                or alone
+                or pending[-1][2]
+                or (opts.max_memory and in_use + need > opts.max_memory)
+            ):
+                future, used, _ = pending.popleft()
+                in_use -= used
+                yield future.result()
+            pending.append((executor.submit(process_worker_file, *job), need, alone))
+            in_use += need
+        while pending:
+            yield pending.popleft()[0].result()
+
+
+def process_files_prefetch(
+    opts: AppOptions, jobs: Iterable[tuple[int, FileInfo, str]]
+) -> Iterator[FileResult]:
+    """
+    Process the jobs in this process, overlapping reading, processing,
+    and saving. Up to opts.prefetch source files are read ahead by a pool
+    of threads, the images are processed here, in job order, and the
+    results are saved by opts.write_threads threads. Pillow releases the
+    GIL while it decodes and encodes, so the threads run alongside the
+    processing. Results are yielded in job order.
+    """
+    print(
+        f"Reading {opts.prefetch} file(s) ahead, saving with "
+        f"{opts.write_threads} thread(s)."
+    )
+
+    with (
+        ThreadPoolExecutor(max_workers=opts.prefetch) as reader,
+        ThreadPoolExecutor(max_workers=opts.write_threads) as writer,
+    ):
+        reads = deque()
+        saves: deque[Future] = deque()
+        job_iter = iter(jobs)
+
+        def read_ahead():
+            while len(reads) < opts.prefetch:
+                job = next(job_iter, None)
+                if job is None:
+                    return
+                reads.append((job, reader.submit(job[1].path.read_bytes)))
+
+        read_ahead()
+        while reads:
+            job, read = reads.popleft()
+            read_ahead()
+
+            file_num = job[0]
+            timer = StageTimer(file_num, opts.profile)
+            try:
+                with timer.stage("read"):
+                    data = read.result()
+                result = process_outputs(opts, *job, timer, data=data)
+            except Exception as e:
+                error = get_job_error(job[1], e)
+                result = FileResult(file_num, "", error, None, tuple(timer.records))
+
+            if isinstance(result, FileOutputs):
+                saves.append(writer.submit(save_outputs, opts, result))
+            else:
+                done = Future()
+                done.set_result(result)
+                saves.append(done)
+
+            #  Limit the processed images waiting to be saved.
+            while len(saves) > opts.write_threads * 2:
+                yield saves.popleft().result()
+
+        while saves:
+            yield saves.popleft().result()
+
+
+def get_source_signature(path: Path, mode: str) -> str:
+    """
+    Returns a string that changes when the source file changes: the
+    modified time and size, or (mode 'hash') the SHA-256 of the content.
+    """
+    if mode == "hash":
+        h = hashlib.sha256()
+        with path.open("rb") as f:
+            while chunk := f.read(1024 * 1024):
+                h.update(chunk)
+        return h.hexdigest()
+    st = path.stat()
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+
+def get_steps_key(steps: tuple[Step, ...]) -> str:
+    """
+    Returns a canonical text for compiled steps, for job keys: the type
+    and values of each step, without its instruction text, so spellings
+    such as 'crop_zoom(100,100)' and 'crop_zoom(100, 100)' give the same
+    key.
+    """
+    parts = []
+    for step in steps:
+        values = [getattr(step, f.name) for f in fields(step) if f.name != "proc"]
+        parts.append((type(step).__name__, values))
+    return repr(parts)
+
+
+def get_branches_key(branches: tuple[Branch, ...]) -> str:
+    return repr(
+        [
+            (b.name, b.output_format, b.output_suffix, get_steps_key(b.steps))
+            for b in branches
+        ]
+    )
+
+
+def get_job_key(
+    opts: AppOptions, file_num: int, file_info: FileInfo, mode: str, *extra: str
+) -> str:
+    """
+    Returns a key for a job: a hash of everything that affects its output
+    image, with the source identified per mode (see get_source_signature),
+    and any extra strings. The caption and numbering are only included
+    when there is a text_footers instruction.
+    """
+    parts = [
+        get_source_signature(file_info.path, mode),
+        get_steps_key(opts.steps),
+        repr(opts.encode),
+        *extra,
+    ]
     if opts.text_font:
-        try:
-            if opts.text_font.lower().endswith(".ttf"):
-                font = ImageFont.truetype(opts.text_font, opts.text_size)
+        parts += [file_info.text, opts.text_numbering, file_num, opts.file_count]
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def read_manifest(out_path: Path) -> dict[str, dict]:
+    """
+    Returns the entries, by output file name, from the manifest in
+    out_path, or an empty dict if there is no manifest (or it cannot be
+    read, in which case every file is processed).
+    """
+    p = out_path / MANIFEST_NAME
+    if not p.exists():
+        return {}
+    try:
+        return json.loads(p.read_text())["files"]
+    except (ValueError, KeyError, TypeError):
+        print(f"WARNING: Cannot read '{p}'. Processing all files.")
+        return {}
+
+
+def write_manifest(out_path: Path, entries: dict[str, dict]):
+    p = out_path / MANIFEST_NAME
+    p.write_text(json.dumps({"version": 1, "files": entries}, indent=2))
+
+
+def process_files_incremental(
+    opts: AppOptions, jobs: Iterable[tuple[int, FileInfo, str]], out_path: Path
+) -> Iterator[FileResult]:
+    """
+    Like process_files(), but skips jobs whose key matches the manifest
+    in out_path and whose output file still exists. Results, including
+    those for skipped jobs, are yielded in job order. The manifest is
+    updated when the results have all been yielded (or processing stops).
+    All jobs are listed before processing starts, to find those to skip.
+    """
+    jobs = list(jobs)
+    entries = read_manifest(out_path)
+
+    keys = {}
+    to_run = []
+    for job in jobs:
+        file_num, file_info, file_name = job
+        key = get_job_key(
+            opts, file_num, file_info, opts.incremental, get_branches_key(opts.branches)
+        )
+        names = [Path(name) for name, _ in get_outputs(opts, *job)]
+        entry = entries.get(file_name)
+        if entry is not None and entry["key"] == key and all(p.exists() for p in names):
+            continue
+        keys[file_num] = key
+        for p in names:
+            if entry is not None and p.exists() and not file_info.path.samefile(p):
+                #  An out of date output made by an earlier run is replaced.
+                p.unlink()
+        to_run.append(job)
+
+    skipped = len(jobs) - len(to_run)
+    if skipped:
+        print(f"Skipping {skipped} unchanged file(s).")
+
+    results = process_files(opts, to_run)
+    try:
+        for file_num, file_info, file_name in jobs:
+            if file_num not in keys:
+                image = None
+                first_name = get_outputs(opts, file_num, file_info, file_name)[0][0]
+                if opts.gif_ms > 0:
+                    #  The earlier output is used as the animated GIF frame.
+                    with Image.open(first_name) as src:
+                        image = src.convert("RGB")
+                yield FileResult(file_num, first_name, "", image)
+                continue
+
+            result = next(results)
+            if result.error:
+                entries.pop(file_name, None)
             else:
-                font = ImageFont.load(opts.text_font)
+                entries[file_name] = {
+                    "source": str(file_info.path),
+                    "key": keys[file_num],
+                }
+            yield result
+    finally:
+        results.close()
+        write_manifest(out_path, entries)
+
+
+class FilePlan(NamedTuple):
+    """
+    The plan for one job, made by plan_file() from the image header.
+
+    outputs: (output_file_name, (width, height)) for each output.
+    pixels: Estimated pixel work: the pixels decoded, the pixels passed
+      to each step, and the pixels encoded.
+    memory: Estimated bytes needed (see estimate_job_memory).
+    warnings: Warnings printed for the steps, as they would be when the
+      image is processed.
+    """
+
+    file_num: int
+    path: Path
+    source_size: tuple[int, int] | None
+    outputs: tuple[tuple[str, tuple[int, int]], ...]
+    pixels: int
+    memory: int
+    warnings: str
+    error: str = ""
+
+
+def plan_steps(
+    steps: tuple[Step, ...], size: tuple[int, int], ctx: ProcContext
+) -> tuple[tuple[int, int], int]:
+    """
+    Returns (size, pixels) after applying steps to an image of the given
+    size, where pixels is the total size of the images passed to them.
+    """
+    pixels = 0
+    for step in steps:
+        pixels += size[0] * size[1]
+        size = step.get_size(size, ctx)
+    return size, pixels
+
+
+def plan_file(
+    opts: AppOptions,
+    file_num: int,
+    file_info: FileInfo,
+    file_name: str,
+    font: ImageFont.ImageFont | ImageFont.FreeTypeFont | None = None,
+) -> FilePlan:
+    """
+    Returns the FilePlan for a job (from get_jobs), using only the size in
+    the image file's header. The steps are planned as load_image() and
+    process_file() would apply them, including the crop and JPEG draft
+    scale chosen by plan_load().
+    """
+    try:
+        size, bands, fmt = read_image_header(file_info.path)
+    except (OSError, Image.DecompressionBombError) as e:
+        return FilePlan(file_num, file_info.path, None, (), 0, 0, "", f"{e}")
+
+    ctx = ProcContext(file_info, file_num, opts.file_count, font)
+    out = io.StringIO()
+    with redirect_stdout(out):
+        plan = plan_load(opts.steps, size, fmt)
+        scale = plan.draft_scale
+        pixels = (size[0] // scale) * (size[1] // scale)
+        shared_size = size
+        if plan.box is not None:
+            x1, y1, x2, y2 = plan.box
+            shared_size = (x2 - x1, y2 - y1)
+        shared_size, step_pixels = plan_steps(plan.steps, shared_size, ctx)
+        pixels += step_pixels
+
+        outputs = []
+        for name, branch in get_outputs(opts, file_num, file_info, file_name):
+            out_size = shared_size
+            if branch is not None:
+                out_size, step_pixels = plan_steps(branch.steps, out_size, ctx)
+                pixels += step_pixels
+            pixels += out_size[0] * out_size[1]
+            outputs.append((name, out_size))
+
+    return FilePlan(
+        file_num,
+        file_info.path,
+        size,
+        tuple(outputs),
+        pixels,
+        estimate_job_memory(size, bands),
+        out.getvalue().strip(),
+    )
+
+
+def run_plan(opts: AppOptions, jobs: Iterable[tuple[int, FileInfo, str]]) -> list[str]:
+    """
+    Prints the plan for each job (see plan_file), followed by a summary
+    that lists the largest jobs. No images are decoded or saved. Returns
+    a list of errors for the files that cannot be read.
+    """
+    font = load_font(opts.text_font, opts.text_size) if opts.text_font else None
+
+    print("Plan (no images are processed):\n")
+    errors = []
+    totals = []
+    warned = 0
+    for job in jobs:
+        fp = plan_file(opts, *job, font)
+        if fp.error:
+            errors.append(f"'{fp.path}': {fp.error}")
+            continue
+        w, h = fp.source_size
+        print(f"{fp.file_num:>5}  '{fp.path}'  {w}x{h}")
+        for name, (w, h) in fp.outputs:
+            print(f"         -> '{Path(name).name}'  {w}x{h}")
+        print(
+            f"         {fp.pixels / 1_000_000:.1f} MP of work, "
+            f"{fp.memory / MEMORY_UNITS['M']:.0f} MB"
+        )
+        if fp.warnings:
+            warned += 1
+            print(indent(fp.warnings, "         "))
+        totals.append((fp.pixels, fp.memory, fp.file_num, fp.path))
+
+    total_mp = sum(t[0] for t in totals) / 1_000_000
+    print(f"\nFiles: {len(totals)}  Pixel work: {total_mp:.1f} MP", end="")
+    print(f"  Files with warnings: {warned}  Errors: {len(errors)}")
+
+    if totals:
+        print("\nLargest jobs:")
+        for pixels, memory, file_num, path in sorted(totals, reverse=True)[:5]:
+            print(
+                f"{file_num:>5}  {pixels / 1_000_000:.1f} MP, "
+                f"{memory / MEMORY_UNITS['M']:.0f} MB  '{path}'"
+            )
+        #  A budget smaller than the largest job makes it run alone.
+        largest = max(t[1] for t in totals)
+        print(f"\nLargest memory estimate: {largest / MEMORY_UNITS['M']:.0f} MB")
+        if opts.max_memory and largest > opts.max_memory:
+            print("  Jobs larger than max_memory will run alone.")
+
+    return errors
+
+
+def add_profile_records(profile: list[ProfileRecord], records):
+    """Add records to the profile list and pass them to the metrics hooks."""
+    for record in records:
+        profile.append(record)
+        for hook in metrics_hooks:
+            hook(record)
+
+
+def iter_gif_images(
+    results: Iterable[FileResult],
+    errors: list[str],
+    profile: list[ProfileRecord] | None = None,
+):
+    """
+    Yields the images from results, in order, for the animated GIF.
+    Error messages are appended to errors, and profile records to profile.
+    """
+    for result in results:
+        if profile is not None:
+            add_profile_records(profile, result.profile)
+        if result.error:
+            errors.append(result.error)
+        elif result.image is not None:
+            yield result.image
+
+
+def iter_timed(images: Iterable, spent: list[float]):
+    """
+    Yields from images, adding the wall and CPU time spent producing
+    them to spent[0] and spent[1]. Used to take the time spent processing
+    files out of the time measured for the animated GIF.
+    """
+    images = iter(images)
+    while True:
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        img = next(images, None)
+        spent[0] += time.perf_counter() - wall
+        spent[1] += time.process_time() - cpu
+        if img is None:
+            return
+        yield img
+
+
+def summarize_profile(profile: list[ProfileRecord]) -> list[dict]:
+    """
+    Returns a list of dicts, one per stage in order of first appearance,
+    with the count, total and mean wall time, total CPU time, and the
+    largest memory peak.
+    """
+    stages: dict[str, dict] = {}
+    for r in profile:
+        s = stages.setdefault(
+            r.stage,
+            {"stage": r.stage, "count": 0, "wall": 0.0, "cpu": 0.0, "mem_peak": None},
+        )
+        s["count"] += 1
+        s["wall"] += r.wall
+        s["cpu"] += r.cpu
+        if r.mem_peak is not None:
+            s["mem_peak"] = max(s["mem_peak"] or 0, r.mem_peak)
+    for s in stages.values():
+        s["wall_mean"] = s["wall"] / s["count"]
+    return list(stages.values())
+
+
+def write_profile_report(profile: list[ProfileRecord], out_path: Path, dt: str):
+    """
+    Print a summary of the profile records by stage, and write all the
+    records and the summary to image_snip_profile-<dt>.json, and the
+    records to image_snip_profile-<dt>.csv, in out_path.
+    """
+    summary = summarize_profile(profile)
+
+    print("\nProfile (seconds):")
+    print(
+        f"  {'stage':<32} {'count':>6} {'wall':>9} {'mean':>9} {'cpu':>9} {'mem_kb':>9}"
+    )
+    for s in summary:
+        mem = "-" if s["mem_peak"] is None else f"{s['mem_peak'] // 1024}"
+        print(
+            f"  {s['stage'][:32]:<32} {s['count']:>6} {s['wall']:>9.3f} "
+            f"{s['wall_mean']:>9.4f} {s['cpu']:>9.3f} {mem:>9}"
+        )
+
+    json_path = out_path / f"image_snip_profile-{dt}.json"
+    print(f"Writing '{json_path}'")
+    json_path.write_text(
+        json.dumps(
+            {"records": [r._asdict() for r in profile], "summary": summary},
+            indent=2,
+        )
+    )
+
+    csv_path = out_path / f"image_snip_profile-{dt}.csv"
+    print(f"Writing '{csv_path}'")
+    with csv_path.open("w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(ProfileRecord._fields)
+        writer.writerows(profile)
+
+
+def iter_length_records(f_in) -> Iterator[bytes]:
+    """
+    Yields the data of each (8-byte big-endian length, data) record read
+    from f_in until the end of the stream.
+    """
+    while head := f_in.read(STREAM_LENGTH.size):
+        if len(head) < STREAM_LENGTH.size:
+            raise ImageSnipError("Incomplete record length at end of stream.")
+        (size,) = STREAM_LENGTH.unpack(head)
+        data = f_in.read(size)
+        if len(data) < size:
+            raise ImageSnipError("Incomplete image data at end of stream.")
+        yield data
+
+
+def stream_branches(
+    pipeline: Pipeline, data: bytes, file_num: int, member_name: str
+) -> list[tuple[str, bytes]]:
+    """
+    Returns (output_name, encoded_data) for each output branch of one
+    image, named member_name, in a tar stream. The image is decoded once.
+    """
+    opts = pipeline.opts
+    with Image.open(io.BytesIO(data)) as src:
+        src_format = src.format
+        images = pipeline.run_branches(src, file_num=file_num, file_count=0)
+    outputs = get_outputs(opts, file_num, FileInfo(Path(member_name)), member_name)
+    return [
+        (
+            name,
+            pipeline.encode(
+                images[branch.name], get_save_format(branch.output_format, src_format)
+            ),
+        )
+        for name, branch in outputs
+    ]
+
+
+def run_stream(opts: AppOptions, f_in, f_out) -> list[str]:
+    """
+    Apply the process instructions to images read from the binary stream
+    f_in and write the results to f_out, framed per opts.stream. Returns a
+    list of error messages for images that could not be processed.
+
+    In 'length' mode an image that fails is written as an empty record,
+    so the output records stay in step with the input. In 'tar' mode it
+    is left out. Output names in a tar file are made by get_output_name.
+    """
+    pipeline = Pipeline(opts)
+    errors = []
+
+    if opts.stream == "single":
+        try:
+            f_out.write(pipeline.run_bytes(f_in.read()))
+        except (ImageSnipError, OSError) as e:
+            errors.append(f"{e}")
+        f_out.flush()
+        return errors
+
+    if opts.stream == "length":
+        for file_num, data in enumerate(iter_length_records(f_in), start=1):
+            print(f"Processing image {file_num}")
+            try:
+                result = pipeline.run_bytes(data, file_num=file_num, file_count=0)
+            except (ImageSnipError, OSError) as e:
+                errors.append(f"Image {file_num}: {e}")
+                result = b""
+            f_out.write(STREAM_LENGTH.pack(len(result)))
+            f_out.write(result)
+            f_out.flush()
+        return errors
+
+    #  tar: members are read and written in order, without seeking.
+    file_num = 0
+    with (
+        tarfile.open(fileobj=f_in, mode="r|*") as tar_in,
+        tarfile.open(fileobj=f_out, mode="w|") as tar_out,
+    ):
+        for member in tar_in:
+            if not member.isfile():
+                continue
+            file_num += 1
+            print(f"Processing '{member.name}'")
+            name = Path(member.name)
+            file_name = get_output_name(name.parent, name.name, opts, file_num)
+            try:
+                data = tar_in.extractfile(member).read()
+                if opts.branches:
+                    results = stream_branches(pipeline, data, file_num, member.name)
+                else:
+                    results = [
+                        (
+                            file_name,
+                            pipeline.run_bytes(data, file_num=file_num, file_count=0),
+                        )
+                    ]
+            except (ImageSnipError, OSError) as e:
+                errors.append(f"'{member.name}': {e}")
+                continue
+            for out_name, result in results:
+                info = tarfile.TarInfo(out_name)
+                info.size = len(result)
+                info.mtime = member.mtime
+                tar_out.addfile(info, io.BytesIO(result))
+    f_out.flush()
+    return errors
+
+
+def check_font(opts: AppOptions) -> bool:
+    """
+    Returns True if there is no text_footers instruction or its font can
+    be loaded. Otherwise prints a warning and returns False.
+    """
+    if opts.text_font:
+        try:
+            load_font(opts.text_font, opts.text_size)
         except OSError:
             print(f"WARNING: Cannot load font '{opts.text_font}'.")
-            return 1
+            return False
         if not opts.text_size:
             print("WARNING: No font size specified.")
+            return False
+    return True
+
+
+def exit_with_errors(errors: list[str]):
+    sys.stderr.write("ERRORS:\n")
+    for msg in errors:
+        sys.stderr.write(f"ERROR: {msg}\n")
+    sys.exit(1)
+
+
+def stream_main(arglist, f_in, f_out) -> int:
+    """
+    main() for --stream mode. Images are read from f_in and written to
+    f_out. Messages that main() would print go to stderr.
+    """
+    with redirect_stdout(sys.stderr):
+        print(f"\n{app_label}\n")
+
+        opts = get_opts(arglist)
+
+        if opts is None:
+            return 0
+
+        if not check_font(opts):
             return 1
 
+        try:
+            errors = run_stream(opts, f_in, f_out)
+        except (ImageSnipError, tarfile.TarError) as e:
+            #  The input stream itself is not valid.
+            errors = [f"{e}"]
+
+    if errors:
+        exit_with_errors(errors)
+
+    return 0
+
+
+def main(arglist=None):
+    if get_args(arglist).stream:
+        return stream_main(arglist, sys.stdin.buffer, sys.stdout.buffer)
+
+    print(f"\n{app_label}\n")
+
+    opts = get_opts(arglist)
+
+    if opts is None:
+        #  Is None if write_template_lines was called.
+        return 0
+
+    if not check_font(opts):
+        return 1
+
+    #  Glob patterns and folders are expanded as the files are processed.
+    files = iter_files(opts)
+    first_file = next(files, None)
+    if first_file is None:
+        sys.stderr.write("ERROR: No image files found.\n")
+        sys.exit(1)
+    files = chain([first_file], files)
+
     dt = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    if opts.plan:
+        #  Nothing is written, not even the output folder.
+        if opts.output_dir:
+            out_path = Path(opts.output_dir)
+        else:
+            out_path = first_file.path.parent / f"crop_{dt}"
+        errors = run_plan(opts, get_jobs(opts, out_path, files))
+        if errors:
+            exit_with_errors(errors)
+        return 0
+
     if not opts.output_dir:
         #  Default to a new directory under the first image files's parent.
-        out_path = opts.files[0].path.parent / f"crop_{dt}"
+        out_path = first_file.path.parent / f"crop_{dt}"
         assert not out_path.exists()
         out_path.mkdir()
     else:
@@ -817,108 +3801,82 @@ def main(arglist=None):
 
     (out_path / f"image_snip_options-{dt}.txt").write_text(opts.opts_text)
 
-    gif_images = []
-
-    for file_num, file_info in enumerate(opts.files, start=1):
-        print(f"Reading '{file_info.path}'")
-
-        src = Image.open(file_info.path)
-
-        img = Image.new("RGB", src.size)
+    errors = []
 
-        img.paste(src, (0, 0))
+    write_profile = opts.profile != PROFILE_OFF
+    if metrics_hooks and not write_profile:
+        #  Stages are timed for the metrics hooks, without a report.
+        opts = opts._replace(profile=PROFILE_TIME)
+    profile = [] if opts.profile != PROFILE_OFF else None
+    was_tracing = tracemalloc.is_tracing()
 
-        if not opts.proc_list:
-            if opts.gif_ms > 0:
-                gif_images.append(str(file_info.path))
+    if not (opts.proc_list or opts.branches):
+        images = iter_source_images(files)
+        gif_name = first_file.path.name
+    else:
+        jobs = get_jobs(opts, out_path, files)
+        first_job = next(jobs)
+        jobs = chain([first_job], jobs)
+        if opts.incremental:
+            results = process_files_incremental(opts, jobs, out_path)
         else:
-            for proc in opts.proc_list:
-                if proc.startswith("crop_from_center"):
-                    target_size = get_target_size(proc, img.size)
-                    crop_box = crop_box_center(img.size, target_size)
-                    img = img.crop(crop_box)
-
-                elif proc.startswith("crop_from_left_top"):
-                    target_size = get_target_size(proc, img.size)
-                    crop_box = crop_box_left_top(img.size, target_size)
-                    img = img.crop(crop_box)
-
-                elif proc.startswith("crop_from_right_top("):
-                    target_size = get_target_size(proc, img.size)
-                    crop_box = crop_box_right_top(img.size, target_size)
-                    img = img.crop(crop_box)
-
-                elif proc.startswith("crop_from_left_bottom("):
-                    target_size = get_target_size(proc, img.size)
-                    crop_box = crop_box_left_bottom(img.size, target_size)
-                    img = img.crop(crop_box)
-
-                elif proc.startswith("crop_from_right_bottom("):
-                    target_size = get_target_size(proc, img.size)
-                    crop_box = crop_box_right_bottom(img.size, target_size)
-                    img = img.crop(crop_box)
-
-                elif proc.startswith("crop_zoom("):
-                    target_size = get_target_size(proc, img.size)
-                    new_size = get_new_size_zoom(img.size, target_size)
-                    img = img.resize(new_size)
-                    target_size = get_target_size(proc, img.size)
-                    crop_box = crop_box_center(img.size, target_size)
-                    img = img.crop(crop_box)
-
-                elif proc.startswith("crop_to_box("):
-                    crop_box = get_target_box(proc, img.size)
-                    img = img.crop(crop_box)
-
-                elif proc.startswith("border("):
-                    img = add_border(img, proc)
-
-                elif proc.startswith("rounded("):
-                    img = add_rounded_border(img, proc)
-
-                elif proc.startswith("text_footers("):
-                    if opts.text_font:
-                        img = add_text_footer(
-                            img,
-                            file_info.text,
-                            font,
-                            opts.text_size,
-                            opts.text_numbering,
-                            file_num,
-                            len(opts.files),
-                        )
+            results = process_files(opts, jobs)
+        images = iter_gif_images(results, errors, profile)
+        gif_name = Path(first_job[2]).name
+
+    #  Use the first file as the basis for the animated GIF (or WebP) name.
+    anim = opts.animation_format
+    gif_path = (out_path / f"z{anim}-{gif_name}").with_suffix(f".{anim}")
+
+    if opts.gif_ms > 0:
+        #  Frames are taken as each file is processed. The GIF encoder
+        #  keeps the palette frames until the file is written.
+        spent = [0.0, 0.0]
+        timer = StageTimer(0, opts.profile)
+        fit_kwargs = {
+            "fit": opts.gif_fit,
+            "resample": opts.gif_resample,
+            "reducing_gap": opts.gif_reducing_gap,
+        }
+        with timer.stage(anim):
+            if anim == "webp":
+                make_webp(
+                    opts.gif_ms,
+                    iter_timed(images, spent),
+                    gif_path,
+                    encode=opts.encode,
+                    **fit_kwargs,
+                )
+            else:
+                make_gif(
+                    opts.gif_ms,
+                    iter_timed(images, spent),
+                    gif_path,
+                    palette_method=opts.gif_palette,
+                    **fit_kwargs,
+                )
+        if profile is not None:
+            #  Leave out the time spent producing the frames.
+            gif = timer.records[0]
+            gif = gif._replace(wall=gif.wall - spent[0], cpu=gif.cpu - spent[1])
+            add_profile_records(profile, [gif])
+    else:
+        for _ in images:
+            pass
 
-                else:
-                    sys.stderr.write(
-                        "ERROR: Unknown process instruction in options file:\n"
-                        f"'{proc}'\n"
-                    )
-                    sys.exit(1)
-
-            file_name = get_output_name(out_path, file_info.path, opts, file_num)
-            print(f"Saving '{file_name}'")
-
-            p = Path(file_name)
-            if p.exists():
-                if opts.do_overwrite:
-                    if file_info.path.samefile(p):
-                        sys.stderr.write(
-                            f"ERROR: Cannot overwrite original file:\n'{p}'\n"
-                        )
-                        sys.exit(1)
-                    else:
-                        p.unlink()
-                else:
-                    sys.stderr.write(f"ERROR: Cannot replace exising file:\n'{p}'\n")
-                    sys.exit(1)
+    if opts.cache_dir:
+        prune_cache(Path(opts.cache_dir), opts.cache_max_mb)
 
-            img.save(file_name)
+    if tracemalloc.is_tracing() and not was_tracing:
+        tracemalloc.stop()
 
-            if opts.gif_ms > 0:
-                gif_images.append(file_name)
+    if write_profile:
+        write_profile_report(profile, out_path, dt)
 
-    if gif_images:
-        make_gif(opts.gif_ms, gif_images, out_path)
+    if errors:
+        if gif_path.exists():
+            gif_path.unlink()
+        exit_with_errors(errors)
 
     return 0
 
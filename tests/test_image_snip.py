@@ -1,3 +1,4 @@
+import json
 import pytest
 import re
 import shutil
@@ -5,7 +6,7 @@ from datetime import datetime
 from pathlib import Path
 from textwrap import dedent
 
-from PIL import Image, ImageFont
+from PIL import Image, ImageChops, ImageFont
 
 import image_snip
 
@@ -768,3 +769,1091 @@ def test_output_suffix_set(tmp_path):
     expected_size = (300, 300)
     assert Image.open(expect_img).size == expected_size
 
+
+
+def test_workers_keep_file_order(tmp_path):
+    out_dir = tmp_path / "output"
+    out_dir.mkdir()
+    opt_dir = tmp_path / "testopts"
+    opt_dir.mkdir()
+    opt_file = opt_dir / "test-workers.txt"
+    opt_file.write_text(
+        dedent(
+            """
+            output_folder: {3}
+            new_name: worker-image
+            workers: 1
+
+            crop_from_left_top(300, 300)
+
+            animated_gif(500)
+
+            {0}
+            {1}
+            {2}
+            """
+        ).format(test_source_image_2, test_source_image_3, test_source_image_4, out_dir)
+    )
+
+    #  The -j option overrides the workers setting in the options file.
+    args = ["-j", "2", str(opt_file)]
+    result = image_snip.main(args)
+    assert result == 0
+
+    for num, src in enumerate(
+        [test_source_image_2, test_source_image_3, test_source_image_4], start=1
+    ):
+        out_img = out_dir / f"worker-image-{num:03d}.jpg"
+        assert out_img.exists()
+        #  Each numbered output should come from the matching source file.
+        expect = Image.open(src).convert("RGB").crop((0, 0, 300, 300))
+        got = Image.open(out_img)
+        assert got.getpixel((150, 150)) == pytest.approx(
+            expect.getpixel((150, 150)), abs=16
+        )
+
+    gif = Image.open(out_dir / "zgif-worker-image-001.gif")
+    assert gif.n_frames == 3
+
+
+def test_workers_collect_errors(tmp_path, capsys):
+    opt, img = get_test_opts_and_img(tmp_path, "crop_zoom(300, 300)", "workers")
+    s = opt.read_text()
+    s = f"new_name: worker-image\n{s}\n{test_source_image_2}"
+    opt.write_text(s)
+
+    #  Existing output files cannot be replaced without the -o option.
+    out_dir = tmp_path / "output"
+    (out_dir / "worker-image-001.jpg").write_text("")
+    (out_dir / "worker-image-002.jpg").write_text("")
+
+    with pytest.raises(SystemExit) as e:
+        image_snip.main(["-j", "2", str(opt)])
+    assert e.value.code == 1
+
+    #  Errors from both files are reported together.
+    captured = capsys.readouterr()
+    assert captured.err.count("Cannot replace exising file") == 2
+
+
+def test_prefetch_keeps_file_order(tmp_path):
+    out_dir = tmp_path / "output"
+    out_dir.mkdir()
+    opt_file = tmp_path / "test-prefetch.txt"
+    sources = [test_source_image_2, test_source_image_3, test_source_image_4]
+    opt_file.write_text(
+        "\n".join(
+            [
+                f"output_folder: {out_dir}",
+                "new_name: prefetch-image",
+                "prefetch: 2",
+                "write_threads: 1",
+                "crop_from_left_top(300, 300)",
+                "animated_gif(500)",
+                *[str(src) for src in sources],
+            ]
+        )
+    )
+
+    assert image_snip.main([str(opt_file)]) == 0
+
+    for num, src in enumerate(sources, start=1):
+        expect = Image.open(src).convert("RGB").crop((0, 0, 300, 300))
+        got = Image.open(out_dir / f"prefetch-image-{num:03d}.jpg")
+        assert got.getpixel((150, 150)) == pytest.approx(
+            expect.getpixel((150, 150)), abs=16
+        )
+
+    gif = Image.open(out_dir / "zgif-prefetch-image-001.gif")
+    assert gif.n_frames == 3
+
+
+def test_prefetch_collects_errors(tmp_path, capsys):
+    opt, _ = get_test_opts_and_img(tmp_path, "crop_zoom(300, 300)", "prefetch")
+    not_image = tmp_path / "not-image.jpg"
+    not_image.write_text("not an image")
+    s = opt.read_text()
+    opt.write_text(
+        f"new_name: pf\nprefetch: 3\n{s}\n{not_image}\n{test_source_image}\n"
+    )
+    out_dir = tmp_path / "output"
+    (out_dir / "pf-003.jpg").write_text("")
+
+    with pytest.raises(SystemExit):
+        image_snip.main([str(opt)])
+
+    err = capsys.readouterr().err
+    assert "cannot identify image file" in err
+    assert "Cannot replace exising file" in err
+    assert (out_dir / "pf-001.jpg").exists()
+
+
+def test_check_image_files_reports_all_missing(tmp_path):
+    tmp_path = tmp_path.resolve()
+    folders = [tmp_path / "a", tmp_path / "b"]
+    lines = []
+    for folder in folders:
+        folder.mkdir()
+        for name in ("one.jpg", "two.jpg"):
+            (folder / name).write_bytes(b"")
+            lines.append((str(folder / name), folder.name))
+        lines.append((str(folder / "missing.jpg"), ""))
+    (tmp_path / "link.jpg").symlink_to(folders[1] / "one.jpg")
+    lines.append((str(tmp_path / "link.jpg"), "link"))
+    lines.append((str(tmp_path / "gone" / "x.jpg"), ""))
+
+    files, errors = image_snip.check_image_files(lines)
+
+    assert [(f.path, f.text) for f in files] == [
+        (folders[0] / "one.jpg", "a"),
+        (folders[0] / "two.jpg", "a"),
+        (folders[1] / "one.jpg", "b"),
+        (folders[1] / "two.jpg", "b"),
+        (folders[1] / "one.jpg", "link"),
+    ]
+    assert errors == [
+        f"File not found: '{folders[0] / 'missing.jpg'}'",
+        f"File not found: '{folders[1] / 'missing.jpg'}'",
+        f"File not found: '{tmp_path / 'gone' / 'x.jpg'}'",
+    ]
+
+
+def test_glob_and_folder_lines(tmp_path):
+    src = tmp_path / "src"
+    (src / "sub" / "deep").mkdir(parents=True)
+    shutil.copyfile(test_source_image_2, src / "b.jpg")
+    shutil.copyfile(test_source_image_3, src / "a.jpg")
+    (src / "notes.txt").write_text("not an image")
+    shutil.copyfile(test_source_image_4, src / "sub" / "deep" / "c.jpg")
+    out_dir = tmp_path / "output"
+    out_dir.mkdir()
+
+    opts_text = "\n".join(
+        [
+            f"output_folder: {out_dir}",
+            "new_name: glob",
+            "crop_from_left_top(100, 100)",
+            "> From folder",
+            str(src),
+            "> From glob",
+            str(src / "**" / "*.jpg"),
+        ]
+    )
+    opts, errors = image_snip.parse_opts_text(opts_text)
+    assert errors == []
+    assert opts.file_count == 0
+    assert [(f.path.name, f.text) for f in image_snip.iter_files(opts)] == [
+        ("a.jpg", "From folder"),
+        ("b.jpg", "From folder"),
+        ("a.jpg", "From glob"),
+        ("b.jpg", "From glob"),
+        ("c.jpg", "From glob"),
+    ]
+
+    opt_file = tmp_path / "test-glob.txt"
+    opt_file.write_text(f"sort: size\n{opts_text}")
+    assert image_snip.main([str(opt_file)]) == 0
+    assert len(list(out_dir.glob("glob-*.jpg"))) == 5
+
+
+def test_existing_names_with_glob_characters(tmp_path):
+    tmp_path = tmp_path.resolve()
+    shutil.copyfile(test_source_image_2, tmp_path / "b [1].jpg")
+    folder = tmp_path / "x [2]"
+    folder.mkdir()
+    shutil.copyfile(test_source_image_3, folder / "c.jpg")
+
+    files, errors = image_snip.check_image_files(
+        [(str(tmp_path / "b [1].jpg"), ""), (str(folder), ""), (str(folder / "*"), "")]
+    )
+
+    assert errors == []
+    assert files[0] == image_snip.FileInfo(tmp_path / "b [1].jpg", "")
+    assert files[1] == image_snip.FilePattern(str(folder), "", is_folder=True)
+    assert files[2] == image_snip.FilePattern(str(folder / "*"), "")
+
+
+def test_glob_leaves_out_output_folders(tmp_path, monkeypatch):
+    photos = tmp_path.resolve() / "photos"
+    photos.mkdir()
+    shutil.copyfile(test_source_image_2, photos / "a.jpg")
+    (photos / "out").mkdir()
+    b_data = test_source_image_3.read_bytes()
+    monkeypatch.chdir(tmp_path)
+
+    opt_file = tmp_path / "test-glob.txt"
+    opt_file.write_text("crop_from_left_top(100, 100)\nphotos/**/*.jpg\n")
+    assert image_snip.main([str(opt_file)]) == 0
+    assert len(list(photos.glob("crop_*/a-crop.jpg"))) == 1
+    (photos / "out" / "b.jpg").write_bytes(b_data)
+
+    opts, errors = image_snip.parse_opts_text(
+        "output_folder: photos/out\nphotos/**/*.jpg\n"
+    )
+    assert errors == []
+    #  Glob matches are resolved, like other image file lines.
+    assert [f.path for f in image_snip.iter_files(opts)] == [photos / "a.jpg"]
+
+
+def test_glob_in_output_folder(tmp_path):
+    #  Outputs written next to the sources are named apart from them.
+    same = tmp_path / "same"
+    same.mkdir()
+    shutil.copyfile(test_source_image_2, same / "s0.jpg")
+
+    opt_file = tmp_path / "test-glob.txt"
+    opt_file.write_text(
+        f"output_folder: {same}\ncrop_from_left_top(100, 100)\n{same}/*.jpg\n"
+    )
+    assert image_snip.main([str(opt_file)]) == 0
+    assert (same / "s0-crop.jpg").exists()
+
+    opts, errors = image_snip.parse_opts_text(f"output_folder: {same}\n{same}\n")
+    assert errors == []
+    assert len(list(image_snip.iter_files(opts))) == 2
+
+
+def test_sort_option_not_valid():
+    _, errors = image_snip.parse_opts_text("sort: random", check_files=False)
+    assert errors == ["sort 'random' not valid. Use one of: name, mtime, size, none."]
+
+
+def test_plan_matches_output_sizes(tmp_path):
+    procs = dedent(
+        """
+        crop_from_left_top(1600, 1200)
+        crop_zoom(333, 250)
+        border_expand(5)
+        branch: wide
+        crop_to_box(10, 10, 900, 100)
+        branch: small
+        crop_zoom(64, 64)
+        rounded(8, 2)
+        output_format: PNG
+        """
+    )
+    opt, _ = get_test_opts_and_img(tmp_path, procs, "plan")
+    opts = image_snip.get_opts([str(opt)])
+    out_path = Path(opts.output_dir)
+
+    plans = [
+        image_snip.plan_file(opts, *job) for job in image_snip.get_jobs(opts, out_path)
+    ]
+    assert "Box coordinates adjusted" in plans[0].warnings
+    assert plans[0].pixels > 0
+
+    assert image_snip.main([str(opt)]) == 0
+    for name, size in plans[0].outputs:
+        assert Image.open(name).size == size
+
+
+def test_plan_option_writes_nothing(tmp_path, capsys):
+    opt, img = get_test_opts_and_img(tmp_path, "crop_from_center(4000, 300)", "plan")
+
+    assert image_snip.main(["--plan", str(opt)]) == 0
+
+    assert list((tmp_path / "output").iterdir()) == []
+    out = capsys.readouterr().out
+    assert f"-> '{img.name}'  1920x300" in out
+    assert "Target image size reduced" in out
+    assert "Files with warnings: 1" in out
+
+
+def test_workers_collect_unexpected_errors(tmp_path, capsys):
+    opt, _ = get_test_opts_and_img(
+        tmp_path, "crop_from_center(300, 300)\nborder(200)", "workers"
+    )
+    opt.write_text(f"{opt.read_text()}\n{test_source_image_2}")
+
+    with pytest.raises(SystemExit):
+        image_snip.main(["-j", "2", str(opt)])
+
+    #  A ValueError from Pillow fails each job, without a traceback.
+    err = capsys.readouterr().err
+    assert err.count("ValueError:") == 2
+    assert "Traceback" not in err
+
+
+def test_invalid_instructions_reported_before_processing(tmp_path, capsys):
+    opt, img = get_test_opts_and_img(
+        tmp_path, "crop_to_box(900, 500, 200, 100)\nborder(4, 0, 0)", "bad_proc"
+    )
+
+    with pytest.raises(SystemExit) as e:
+        image_snip.main([str(opt)])
+    assert e.value.code == 1
+
+    captured = capsys.readouterr()
+    assert "Invalid box coordinates" in captured.err
+    assert "Expected 1 or 4 arguments" in captured.err
+    assert "Reading '" not in captured.out
+    assert not img.exists()
+
+
+def test_compiled_steps_are_immutable_and_picklable():
+    import pickle
+
+    steps, errors = image_snip.compile_steps(
+        ["crop_zoom(400, 300)", "border(4)", "rounded(8, 2, 0, 255, 0)"]
+    )
+    assert not errors
+    assert isinstance(steps[0], image_snip.CropZoomStep)
+    assert steps[0].size == (400, 300)
+    assert steps[1].rgb == image_snip.FOOTER_BACKGROUND_RGB
+    assert pickle.loads(pickle.dumps(steps)) == steps
+    with pytest.raises(AttributeError):
+        steps[0].size = (1, 1)
+
+
+def test_step_requires_apply():
+    with pytest.raises(TypeError):
+        image_snip.Step("unknown()")
+
+
+def test_plan_load_folds_leading_crops():
+    steps, _ = image_snip.compile_steps(
+        [
+            "crop_to_box(100, 100, 1100, 900)",
+            "crop_from_right_bottom(600, 400)",
+            "crop_zoom(100, 100)",
+            "border(2)",
+        ]
+    )
+    plan = image_snip.plan_load(steps, (1920, 1440), "JPEG")
+    assert plan.box == (500, 500, 1100, 900)
+    #  The 600x400 region can be decoded at 1/4 scale and still cover 100x100.
+    assert plan.draft_scale == 4
+    assert plan.steps == steps[2:]
+
+    #  No draft scaling for formats other than JPEG.
+    plan = image_snip.plan_load(steps, (1920, 1440), "PNG")
+    assert plan.draft_scale == 1
+
+
+def test_load_image_matches_step_by_step_crop(tmp_path):
+    img_file = tmp_path / "a.png"
+    src = Image.open(test_source_image).convert("RGB")
+    src.save(img_file)
+
+    steps, _ = image_snip.compile_steps(
+        ["crop_from_center(1200, 1000)", "crop_to_box(10, 20, 610, 420)"]
+    )
+    img, remaining = image_snip.load_image(Image.open(img_file), steps)
+    assert remaining == ()
+
+    expect = src.crop((360, 220, 1560, 1220)).crop((10, 20, 610, 420))
+    assert img.tobytes() == expect.tobytes()
+
+
+def test_crop_zoom_with_jpeg_draft(tmp_path):
+    opt, img = get_test_opts_and_img(
+        tmp_path, "crop_from_left_top(1600, 1200)\ncrop_zoom(320, 200)", "draft"
+    )
+
+    args = [str(opt)]
+    result = image_snip.main(args)
+
+    assert result == 0
+    assert Image.open(img).size == (320, 200)
+
+
+def test_crop_zoom_single_resize_matches_resize_then_crop():
+    src = Image.effect_noise((1001, 777), 40).convert("RGB")
+    step = image_snip.compile_step("crop_zoom(333, 199)")
+    img = step.apply(src, None)
+
+    zoomed = src.resize(image_snip.get_new_size_zoom(src.size, (333, 199)))
+    expect = zoomed.crop(image_snip.crop_box_center(zoomed.size, (333, 199)))
+    assert img.size == expect.size
+    diff = ImageChops.difference(img, expect).getextrema()
+    assert max(hi for _, hi in diff) <= 16
+
+
+def test_crop_zoom_resample_settings(tmp_path, capsys):
+    opts, errors = image_snip.parse_opts_text(
+        "resample: Lanczos\nreducing_gap: 2.5\ncrop_zoom(100, 100)", check_files=False
+    )
+    assert errors == []
+    assert opts.steps[0].resample == "lanczos"
+    assert opts.steps[0].reducing_gap == 2.5
+
+    opt, img = get_test_opts_and_img(
+        tmp_path, "crop_zoom(100, 100)\nresample: fancy\nreducing_gap: 0.5", "rs"
+    )
+    with pytest.raises(SystemExit):
+        image_snip.main([str(opt)])
+    err = capsys.readouterr().err
+    assert "resample 'fancy' not valid" in err
+    assert "reducing_gap must be 1.0 or greater" in err
+
+
+def test_load_image_converts_only_when_needed(tmp_path):
+    steps, _ = image_snip.compile_steps(["border(2)"])
+
+    rgb_file = tmp_path / "rgb.png"
+    Image.new("RGB", (50, 40), (10, 20, 30)).save(rgb_file)
+    with Image.open(rgb_file) as src:
+        img, remaining = image_snip.load_image(src, steps)
+        #  Already RGB and not cropped, so no copy is made.
+        assert img is src
+    assert remaining == steps
+    assert img.getpixel((0, 0)) == (10, 20, 30)
+
+    rgba_file = tmp_path / "rgba.png"
+    Image.new("RGBA", (50, 40), (10, 20, 30, 128)).save(rgba_file)
+    with Image.open(rgba_file) as src:
+        img, _ = image_snip.load_image(src, steps)
+    assert img.mode == "RGB"
+    assert img.getpixel((0, 0)) == (10, 20, 30)
+
+
+def test_make_gif_from_generator(tmp_path):
+    produced = []
+
+    def frames():
+        for n in range(5):
+            img = Image.new("RGB", (60, 40), (n * 50, 0, 255 - n * 50))
+            produced.append(n)
+            yield img
+
+    gif_path = tmp_path / "frames.gif"
+    image_snip.make_gif(100, frames(), gif_path)
+
+    assert produced == [0, 1, 2, 3, 4]
+    gif = Image.open(gif_path)
+    assert gif.n_frames == 5
+    gif.seek(4)
+    assert gif.convert("RGB").getpixel((0, 0)) == (200, 0, 55)
+
+
+def test_make_gif_no_frames(tmp_path):
+    gif_path = tmp_path / "empty.gif"
+    image_snip.make_gif(100, iter([]), gif_path)
+    assert not gif_path.exists()
+
+
+@pytest.mark.parametrize("method", ["median", "octree"])
+def test_make_gif_shared_palette(tmp_path, method):
+    images = [
+        Image.open(src).convert("RGB")
+        for src in (test_source_image_2, test_source_image_3, test_source_image_4)
+    ]
+    gif_path = tmp_path / "shared.gif"
+    image_snip.make_gif(100, iter(images), gif_path, palette_method=method)
+
+    gif = Image.open(gif_path)
+    assert gif.n_frames == 3
+    pal = gif.getpalette()
+    palette_colors = {tuple(pal[i : i + 3]) for i in range(0, len(pal), 3)}
+
+    #  Every frame uses only colors from the first (global) palette.
+    for n in range(gif.n_frames):
+        gif.seek(n)
+        colors = {c for _, c in gif.convert("RGB").getcolors(1 << 20)}
+        assert colors <= palette_colors
+
+
+def test_gif_palette_option_not_valid(tmp_path, capsys):
+    opt, img = get_test_opts_and_img(
+        tmp_path, "animated_gif(100)\ngif_palette: fancy", "gif_palette"
+    )
+    with pytest.raises(SystemExit):
+        image_snip.main([str(opt)])
+    assert "gif_palette 'fancy' not valid" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("fit", ["resize", "crop", "letterbox"])
+def test_make_gif_fits_frames_to_first_size(tmp_path, fit):
+    images = [
+        Image.new("RGB", (120, 80), (255, 0, 0)),
+        Image.new("RGB", (300, 100), (0, 255, 0)),
+        Image.new("RGB", (60, 90), (0, 0, 255)),
+    ]
+    gif_path = tmp_path / f"{fit}.gif"
+    image_snip.make_gif(100, iter(images), gif_path, fit=fit, resample="nearest")
+
+    gif = Image.open(gif_path)
+    assert gif.n_frames == 3
+    for n in range(3):
+        gif.seek(n)
+        assert gif.size == (120, 80)
+
+
+def test_fit_frame_letterbox_and_crop():
+    img = Image.new("RGB", (200, 100), (0, 255, 0))
+
+    boxed = image_snip.fit_frame(img, (100, 100), "letterbox", "nearest")
+    assert boxed.size == (100, 100)
+    assert boxed.getpixel((50, 10)) == (0, 0, 0), "Should be a black bar"
+    assert boxed.getpixel((50, 50)) == (0, 255, 0)
+
+    img.paste((255, 0, 0), (0, 0, 50, 100))
+    cropped = image_snip.fit_frame(img, (100, 100), "crop", "nearest")
+    assert cropped.size == (100, 100)
+    #  The red left edge is cropped away.
+    assert cropped.getpixel((0, 50)) == (0, 255, 0)
+
+
+@pytest.mark.parametrize("frame_size", [(274, 200), (201, 700), (1999, 1500)])
+def test_fit_frame_crop_other_aspect_ratio(frame_size):
+    #  The zoomed size is rounded down and may be a pixel short.
+    img = Image.new("RGB", frame_size, (0, 255, 0))
+    cropped = image_snip.fit_frame(img, (640, 480), "crop")
+    assert cropped.size == (640, 480)
+
+
+def test_animated_gif_crop_fit(tmp_path):
+    out_dir = tmp_path / "output"
+    out_dir.mkdir()
+    src_1 = tmp_path / "a.png"
+    src_2 = tmp_path / "b.png"
+    Image.new("RGB", (640, 480), (255, 0, 0)).save(src_1)
+    Image.new("RGB", (274, 200), (0, 0, 255)).save(src_2)
+    opt_file = tmp_path / "gif-crop.txt"
+    opt_file.write_text(
+        f"output_folder: {out_dir}\nanimated_gif(100)\ngif_fit: crop\n"
+        f"{src_1}\n{src_2}\n"
+    )
+
+    assert image_snip.main([str(opt_file)]) == 0
+
+    gif_files = list(out_dir.glob("*.gif"))
+    assert len(gif_files) == 1
+    gif = Image.open(gif_files[0])
+    assert gif.n_frames == 2
+    gif.seek(1)
+    assert gif.size == (640, 480)
+
+
+def test_add_text_footer_default_font():
+    """
+    Test add_text_footer() using Pillow's built-in font, so the test does
+    not depend on the fonts installed on the system.
+    """
+    font = ImageFont.load_default(15)
+    est_ht = int(font.getlength("M")) + 20
+
+    image = Image.new("RGB", (200, 100), color=(128, 128, 128))
+    first = image_snip.add_text_footer(image, "Test", font, 15, 2, 1, 3)
+    second = image_snip.add_text_footer(image, "", font, 15, 0, 2, 3)
+
+    band_h = est_ht + (image_snip.FOOTER_PAD_PX * 2)
+    assert first.size == (200, 100 + band_h)
+    assert second.size == first.size
+    assert first.getpixel((0, 99)) == (128, 128, 128)
+    assert first.getpixel((0, 100)) == image_snip.FOOTER_BACKGROUND_RGB
+    #  Text is drawn only on the first image.
+    assert first.crop((0, 100, 200, 100 + band_h)).getcolors(1000) != [
+        (200 * band_h, image_snip.FOOTER_BACKGROUND_RGB)
+    ]
+    assert second.crop((0, 100, 200, 100 + band_h)).getcolors(1000) == [
+        (200 * band_h, image_snip.FOOTER_BACKGROUND_RGB)
+    ]
+    #  The metrics and the blank footer band are reused.
+    assert image_snip.get_est_text_ht.cache_info().hits >= 1
+    assert image_snip.get_footer_band.cache_info().hits >= 1
+
+
+@pytest.mark.parametrize(
+    "size, radius, padding",
+    [((100, 100), 8, 2), ((640, 481), 20, 0), ((37, 200), 8, 5), ((300, 90), 0, 1)],
+)
+def test_rounded_mask_from_corners_matches_full_mask(size, radius, padding):
+    full = image_snip.make_rounded_mask(size, radius, padding, 1)
+    tiled = image_snip.get_rounded_mask(size, radius, padding, 1)
+    assert tiled.tobytes() == full.tobytes()
+    #  Cached for the next image of the same size.
+    assert image_snip.get_rounded_mask(size, radius, padding, 1) is tiled
+
+
+def test_border_inset_and_expand(tmp_path):
+    dir_path = tmp_path / "test_border_modes"
+    dir_path.mkdir()
+    img_file = dir_path / "a.png"
+    img = Image.new("RGB", (100, 100), color=(255, 255, 255))
+    img.putpixel((50, 50), (255, 0, 0))
+    img.save(img_file)
+
+    for proc, expect_size, inner in [
+        ("border_inset(4, 0, 0, 0)", (100, 100), (50, 50)),
+        ("border_expand(4, 0, 0, 0)", (108, 108), (54, 54)),
+    ]:
+        out_path = dir_path / proc.split("(")[0]
+        out_path.mkdir()
+        opt_file = dir_path / "test-border-modes.txt"
+        opt_file.write_text(f"output_folder: {out_path}\n{proc}\n{img_file}\n")
+
+        assert image_snip.main([str(opt_file)]) == 0
+
+        out_img = Image.open(out_path / "a-crop.png")
+        assert out_img.size == expect_size
+        assert out_img.getpixel((3, 3)) == (0, 0, 0), "Should be black border"
+        assert out_img.getpixel((4, 4)) == (255, 255, 255)
+        #  No resampling, so the single red pixel is unchanged.
+        assert out_img.getpixel(inner) == (255, 0, 0)
+
+
+def test_profile_report(tmp_path):
+    out_dir = tmp_path / "output"
+    out_dir.mkdir()
+    opt_file = tmp_path / "test-profile.txt"
+    opt_file.write_text(
+        dedent(
+            """
+            output_folder: {2}
+            crop_from_left_top(300, 300)
+            border(4)
+            animated_gif(100)
+            {0}
+            {1}
+            """
+        ).format(test_source_image_2, test_source_image_3, out_dir)
+    )
+
+    result = image_snip.main(["--profile", str(opt_file)])
+    assert result == 0
+
+    json_files = list(out_dir.glob("image_snip_profile-*.json"))
+    assert len(json_files) == 1
+    assert len(list(out_dir.glob("image_snip_profile-*.csv"))) == 1
+
+    data = json.loads(json_files[0].read_text())
+    stages = [s["stage"] for s in data["summary"]]
+    #  The leading crop is done while loading.
+    assert stages == ["load", "border(4)", "save", "gif"]
+    assert data["summary"][0]["count"] == 2
+    assert all(r["wall"] >= 0 for r in data["records"])
+
+
+def test_stage_memory_only_recorded_in_main_thread():
+    from concurrent.futures import ThreadPoolExecutor
+
+    timer = image_snip.StageTimer(1, image_snip.PROFILE_MEMORY)
+
+    def timed(name):
+        with timer.stage(name):
+            pass
+
+    timed("main")
+    with ThreadPoolExecutor(1) as executor:
+        executor.submit(timed, "thread").result()
+
+    peaks = {r.stage: r.mem_peak for r in timer.records}
+    assert peaks["main"] is not None
+    assert peaks["thread"] is None
+
+
+def test_metrics_hook(tmp_path):
+    opt, img = get_test_opts_and_img(tmp_path, "crop_zoom(300, 300)", "hook")
+
+    records = []
+    image_snip.add_metrics_hook(records.append)
+    try:
+        assert image_snip.main(["--profile-memory", str(opt)]) == 0
+    finally:
+        image_snip.remove_metrics_hook(records.append)
+
+    assert [r.stage for r in records] == ["load", "crop_zoom(300, 300)", "save"]
+    assert all(r.file_num == 1 for r in records)
+    assert all(r.mem_peak is not None for r in records)
+
+
+def test_pipeline_matches_main(tmp_path):
+    procs = "crop_from_center(800, 600)\nborder(4, 255, 0, 0)"
+    opt, img = get_test_opts_and_img(tmp_path, procs, "pipeline")
+    assert image_snip.main([str(opt)]) == 0
+
+    pipeline = image_snip.Pipeline.from_text(procs)
+    with Image.open(test_source_image) as src:
+        result = pipeline.run(src)
+        #  The caller's image is not closed.
+        assert src.size == (1920, 1440)
+
+    assert result.size == (800, 600)
+    with Image.open(img) as expected:
+        assert result.size == expected.size
+
+    data = image_snip.Pipeline.from_text(
+        f"output_format: JPG\n{procs}\n/not/a/real/file.jpg"
+    ).run_bytes(test_source_image.read_bytes())
+    assert data[:2] == b"\xff\xd8"
+
+
+def test_pipeline_leaves_caller_image_unchanged(tmp_path):
+    jpg = tmp_path / "big.jpg"
+    Image.new("RGB", (600, 400), (0, 128, 255)).save(jpg)
+
+    with Image.open(jpg) as src:
+        result = image_snip.Pipeline.from_text("crop_zoom(100, 60)").run(src)
+        #  The JPEG is not draft scaled in place.
+        assert src.size == (600, 400)
+    assert result.size == (100, 60)
+
+    img = Image.new("RGB", (100, 60))
+    result = image_snip.Pipeline.from_text("output_format: png").run(img)
+    assert result is not img
+
+
+def test_pipeline_invalid_text():
+    with pytest.raises(image_snip.ImageSnipError) as e:
+        image_snip.Pipeline.from_text("crop_zoom(0, 10)\ngif_fit: wrong")
+    assert len(str(e.value).splitlines()) == 2
+
+
+@pytest.mark.parametrize("text", ["border(4", "rotate(90)", "gif_fitt: crop"])
+def test_pipeline_unknown_line(text):
+    with pytest.raises(image_snip.ImageSnipError, match="Unknown line"):
+        image_snip.Pipeline.from_text(f"crop_zoom(100, 100)\n{text}")
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["photos/a.jpg", "Photo (2).jpg", "IMG_001 (copy).JPG", "Trip (2) - copy"],
+)
+def test_pipeline_ignores_file_names(text):
+    assert image_snip.Pipeline.from_text(f"crop_zoom(100, 100)\n{text}")
+
+
+def get_stream_opts(stream: str, *lines: str) -> image_snip.AppOptions:
+    opts, errors = image_snip.parse_opts_text("\n".join(lines), check_files=False)
+    assert errors == []
+    return opts._replace(stream=stream)
+
+
+def test_stream_length_records():
+    import io
+
+    data = test_source_image_2.read_bytes()
+    records = b"".join(
+        image_snip.STREAM_LENGTH.pack(len(d)) + d for d in (data, b"not an image", data)
+    )
+    f_out = io.BytesIO()
+    opts = get_stream_opts("length", "crop_from_center(200, 100)")
+    errors = image_snip.run_stream(opts, io.BytesIO(records), f_out)
+
+    assert len(errors) == 1
+    assert errors[0].startswith("Image 2:")
+    results = list(image_snip.iter_length_records(io.BytesIO(f_out.getvalue())))
+    assert [len(r) > 0 for r in results] == [True, False, True]
+    with Image.open(io.BytesIO(results[2])) as img:
+        assert img.format == "JPEG"
+        assert img.size == (200, 100)
+
+
+def test_stream_tar():
+    import io
+    import tarfile
+
+    f_in = io.BytesIO()
+    with tarfile.open(fileobj=f_in, mode="w") as tar:
+        for name in ("a/one.jpg", "two.jpg"):
+            tar.add(test_source_image_3, arcname=name)
+    f_in.seek(0)
+
+    f_out = io.BytesIO()
+    opts = get_stream_opts("tar", "output_format: PNG", "border(4)")
+    assert image_snip.run_stream(opts, f_in, f_out) == []
+
+    f_out.seek(0)
+    with tarfile.open(fileobj=f_out) as tar:
+        assert tar.getnames() == ["a/one-crop.png", "two-crop.png"]
+        with Image.open(tar.extractfile("two-crop.png")) as img:
+            assert img.format == "PNG"
+            assert img.size == (400, 400)
+
+
+def test_stream_single_from_main(monkeypatch, capsysbinary):
+    import io
+
+    class FakeStdin:
+        buffer = io.BytesIO(test_source_image_4.read_bytes())
+
+    monkeypatch.setattr("sys.stdin", FakeStdin)
+    args = ["--stream", "single", "--proc", "crop_zoom(100, 50)"]
+    assert image_snip.main(args) == 0
+
+    captured = capsysbinary.readouterr()
+    assert b"image_snip" in captured.err
+    with Image.open(io.BytesIO(captured.out)) as img:
+        assert img.size == (100, 50)
+
+
+@pytest.mark.parametrize(
+    ("procs", "message"),
+    [
+        (["crop_zoom(100, 100"], "Unknown line"),
+        (["animated_gif(100)"], "No process instructions"),
+    ],
+)
+def test_stream_not_valid(procs, message, capsys):
+    args = ["--stream", "single"]
+    for proc in procs:
+        args += ["--proc", proc]
+    with pytest.raises(SystemExit) as e:
+        image_snip.main(args)
+    assert e.value.code == 1
+    assert message in capsys.readouterr().err
+
+
+def test_incremental_skips_unchanged_files(tmp_path, capsys, monkeypatch):
+    out_dir = tmp_path / "output"
+    out_dir.mkdir()
+    src_files = []
+    for n, src in enumerate([test_source_image_2, test_source_image_3], start=1):
+        p = tmp_path / f"src-{n}.jpg"
+        shutil.copyfile(src, p)
+        src_files.append(p)
+
+    def write_opts(caption: str):
+        opt_file = tmp_path / "options.txt"
+        opt_file.write_text(
+            f"output_folder: {out_dir}\nincremental: hash\n"
+            'text_footers("default", 12, 1)\ncrop_zoom(100, 100)\n'
+            f"> {caption}\n{src_files[0]}\n> Second\n{src_files[1]}\n"
+        )
+        return opt_file
+
+    #  Use Pillow's built-in font, so the test does not depend on the fonts
+    #  installed on the system.
+    monkeypatch.setattr(
+        image_snip, "load_font", lambda name, size: ImageFont.load_default(size)
+    )
+
+    assert image_snip.main([str(write_opts("First"))]) == 0
+    manifest = out_dir / image_snip.MANIFEST_NAME
+    assert len(json.loads(manifest.read_text())["files"]) == 2
+    first_out = out_dir / "src-1-crop.jpg"
+    second_out = out_dir / "src-2-crop.jpg"
+    second_mtime = second_out.stat().st_mtime_ns
+    capsys.readouterr()
+
+    #  Nothing changed.
+    assert image_snip.main([str(write_opts("First"))]) == 0
+    out = capsys.readouterr().out
+    assert "Skipping 2 unchanged" in out
+    assert "Saving" not in out
+
+    #  Only the file with the new caption is processed again, and the
+    #  earlier output is replaced without the overwrite option.
+    assert image_snip.main([str(write_opts("Changed"))]) == 0
+    out = capsys.readouterr().out
+    assert "Skipping 1 unchanged" in out
+    assert f"Saving '{first_out}'" in out
+    assert second_out.stat().st_mtime_ns == second_mtime
+
+    #  A missing output is made again.
+    second_out.unlink()
+    assert image_snip.main([str(write_opts("Changed"))]) == 0
+    assert second_out.exists()
+
+
+def test_result_cache_shared_across_output_folders(tmp_path, capsys):
+    cache_dir = tmp_path / "cache"
+    outputs = []
+    #  Spellings of the same instruction share a cached result.
+    crops = ["crop_from_center(200, 150)", "crop_from_center(200,150)"]
+    for n, crop in enumerate(crops):
+        out_dir = tmp_path / f"output-{n}"
+        out_dir.mkdir()
+        opt_file = tmp_path / f"options-{n}.txt"
+        opt_file.write_text(
+            f"output_folder: {out_dir}\ncache_dir: {cache_dir}\n"
+            f"{crop}\nborder(3)\n{test_source_image_2.resolve()}\n"
+        )
+        assert image_snip.main([str(opt_file)]) == 0
+        outputs.append(out_dir / f"{test_source_image_2.stem}-crop.jpg")
+
+    out = capsys.readouterr().out
+    assert out.count("Using cached result") == 1
+    assert outputs[0].read_bytes() == outputs[1].read_bytes()
+    assert len(list(cache_dir.glob("*/*.jpg"))) == 1
+
+    image_snip.prune_cache(cache_dir, 0)
+    assert list(cache_dir.glob("*/*.jpg")) == []
+
+
+def test_encoder_settings(tmp_path):
+    procs = "jpeg_quality: 40\njpeg_progressive: yes\ncrop_from_center(400, 300)"
+    opt, img = get_test_opts_and_img(tmp_path, procs, "encode")
+    assert image_snip.main([str(opt)]) == 0
+    with Image.open(img) as result:
+        assert result.info.get("progressive")
+
+    opts, errors = image_snip.parse_opts_text(
+        "encoder_preset: fast\npng_compress_level: 3", check_files=False
+    )
+    assert errors == []
+    assert opts.encode.jpeg_quality == 60
+    assert opts.encode.png_compress_level == 3
+    assert image_snip.get_save_kwargs(opts.encode, "PNG") == {
+        "compress_level": 3,
+        "optimize": False,
+    }
+
+    _, errors = image_snip.parse_opts_text(
+        "jpeg_quality: 101\npng_optimize: maybe\njpeg_subsampling: 4:1:1\n"
+        "encoder_preset: slow",
+        check_files=False,
+    )
+    assert len(errors) == 4
+
+
+def test_number_settings_not_valid():
+    lines = ["jpeg_quality: hi", "workers: x", "reducing_gap: a", "cache_max_mb: 1.5"]
+    with pytest.raises(image_snip.ImageSnipError) as e:
+        image_snip.Pipeline.from_text("\n".join(["crop_zoom(100, 100)", *lines]))
+    assert str(e.value).splitlines() == [
+        "Expected a whole number in 'jpeg_quality: hi'",
+        "Expected a whole number in 'workers: x'",
+        "Expected a number in 'reducing_gap: a'",
+        "Expected a whole number in 'cache_max_mb: 1.5'",
+    ]
+
+
+def test_png_compress_level_changes_size():
+    data = test_source_image_2.read_bytes()
+    sizes = [
+        len(
+            image_snip.Pipeline.from_text(
+                f"output_format: PNG\npng_compress_level: {level}"
+            ).run_bytes(data)
+        )
+        for level in (1, 9)
+    ]
+    assert sizes[0] > sizes[1]
+
+
+@pytest.mark.parametrize("fmt", ["WEBP", "AVIF"])
+def test_output_format_webp_avif(tmp_path, fmt):
+    from PIL import features
+
+    if not features.check(fmt.lower()):
+        pytest.skip(f"Pillow was built without {fmt} support.")
+
+    procs = f"output_format: {fmt.lower()}\n{fmt.lower()}_quality: 50\nborder(4)"
+    opt, img = get_test_opts_and_img(tmp_path, procs, fmt.lower())
+    assert image_snip.main([str(opt)]) == 0
+    result = img.with_suffix(f".{fmt.lower()}")
+    with Image.open(result) as out:
+        assert out.format == fmt
+        assert out.size == (1920, 1440)
+
+
+def test_animated_webp(tmp_path):
+    out_dir = tmp_path / "output"
+    out_dir.mkdir()
+    opt_file = tmp_path / "options.txt"
+    opt_file.write_text(
+        f"output_folder: {out_dir}\nanimated_webp(500)\nencoder_preset: fast\n"
+        f"{test_source_image_2.resolve()}\n{test_source_image_3.resolve()}\n"
+    )
+    assert image_snip.main([str(opt_file)]) == 0
+    webp_files = list(out_dir.glob("zwebp-*.webp"))
+    assert len(webp_files) == 1
+    with Image.open(webp_files[0]) as webp:
+        assert webp.n_frames == 2
+        webp.seek(1)
+        webp.load()
+        assert webp.info["duration"] == 500
+
+
+def test_output_branches(tmp_path, capsys):
+    out_dir = tmp_path / "output"
+    out_dir.mkdir()
+    opt_file = tmp_path / "options.txt"
+    opt_file.write_text(
+        dedent(
+            f"""
+            output_folder: {out_dir}
+            crop_from_center(300, 300)
+
+            branch: thumb
+            crop_zoom(100, 100)
+            output_format: PNG
+
+            branch: card
+            border_expand(10)
+            output_suffix: social
+
+            {test_source_image_2.resolve()}
+            """
+        )
+    )
+    assert image_snip.main(["--profile", str(opt_file)]) == 0
+
+    stem = test_source_image_2.stem
+    with Image.open(out_dir / f"{stem}-thumb.png") as thumb:
+        assert thumb.size == (100, 100)
+    with Image.open(out_dir / f"{stem}-social.jpg") as card:
+        assert card.size == (320, 320)
+    assert not (out_dir / f"{stem}-crop.jpg").exists()
+
+    #  The source is read once, and the shared step is done while loading.
+    data = json.loads(next(out_dir.glob("image_snip_profile-*.json")).read_text())
+    stages = [r["stage"] for r in data["records"]]
+    assert stages.count("load") == 1
+    assert "thumb: crop_zoom(100, 100)" in stages
+    assert stages.count("save") == 2
+
+
+def test_output_branches_not_valid():
+    _, errors = image_snip.parse_opts_text(
+        "branch: a\ncrop_zoom(0, 1)\nbranch: a\nbranch: b\noutput_suffix: a",
+        check_files=False,
+    )
+    assert len(errors) == 3
+
+
+def test_job_memory_estimate(monkeypatch):
+    info = image_snip.FileInfo(test_source_image_2.resolve(), "")
+    assert image_snip.get_job_memory(info) == (400 * 400 * 3 * 3, False)
+
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100_000)
+    assert image_snip.get_job_memory(info)[1] is True
+
+    opts, errors = image_snip.parse_opts_text(
+        "max_memory: 1.5G", check_files=False
+    )
+    assert errors == []
+    assert opts.max_memory == int(1.5 * 1024**3)
+    assert image_snip.parse_opts_text("max_memory: lots", check_files=False)[1]
+
+
+def test_no_memory_budget_skips_header_reads(tmp_path, monkeypatch):
+    out_dir = tmp_path / "output"
+    out_dir.mkdir()
+    sources = [test_source_image_2, test_source_image_3]
+    opt_file = tmp_path / "options.txt"
+    opt_file.write_text(
+        f"output_folder: {out_dir}\nworkers: 2\ncrop_from_center(100, 100)\n"
+        + "\n".join(str(p.resolve()) for p in sources)
+    )
+
+    def fail(file_info):
+        raise AssertionError("Header read without a memory budget")
+
+    monkeypatch.setattr(image_snip, "get_job_memory", fail)
+    assert image_snip.main([str(opt_file)]) == 0
+    assert len(list(out_dir.glob("*.jpg"))) == 2
+
+
+def test_memory_budget_runs_jobs_alone_in_order(tmp_path, capsys):
+    out_dir = tmp_path / "output"
+    out_dir.mkdir()
+    sources = [test_source_image_2, test_source_image_3, test_source_image_4]
+    opt_file = tmp_path / "options.txt"
+    opt_file.write_text(
+        f"output_folder: {out_dir}\nnew_name: out\nworkers: 2\nmax_memory: 1M\n"
+        "crop_from_center(100, 100)\n"
+        + "\n".join(str(p.resolve()) for p in sources)
+    )
+    assert image_snip.main([str(opt_file)]) == 0
+
+    out = capsys.readouterr().out
+    #  Each image needs more than the budget, so each runs alone.
+    assert out.count("running alone") == 3
+    assert sorted(p.name for p in out_dir.glob("out-*.jpg")) == [
+        "out-001.jpg",
+        "out-002.jpg",
+        "out-003.jpg",
+    ]